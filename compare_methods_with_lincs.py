@@ -1,8 +1,10 @@
 ### Author: Edward Huang
 
 import file_operations
+import fisher_test
+import numpy as np
 import os
-from scipy.stats import fisher_exact
+import ranking_file
 import sys
 import time
 
@@ -12,6 +14,8 @@ import time
 ### level 4 LINCS data by finding the size of the intersection of genes that
 ### have p-values below 0.0001, 0.001, 0.01, and 0.05. Computes the Fisher's
 ### test on these intersections, differentiating between cell lines and drugs.
+### Each ranking file is read once into drugs x pathways masks, and the tables
+### of all threshold pairs and drugs are counted and tested together.
 ### Run time: 35 seconds per file. Up to 6 files (ppi)
 
 embedding_methods = ['ppi', 'genetic', 'literome', 'sequence']
@@ -20,119 +24,140 @@ corr_kw_fname = './results/correlation_top_pathways_kw.txt'
 
 pathways = set([])
 
-def get_corr_kw_path_dct(method_p_thresh):
+def get_path_codes(rankings, path_index_dct):
     '''
-    Returns a dictionary.
-    Each key is a drug.
-    Each value is the set of paths most associated with the drug via the
-    correlation baseline method.
+    Returns the index in path_index_dct of each pathway of a RankingFile, to
+    map its pathway codes onto the shared pathway columns -> np.array(int)
     '''
-    global pathways
-    corr_kw_path_dct = {}
-
-    corr_file = open(corr_kw_fname, 'r')
-    for i, line in enumerate(corr_file):
-        if i < 2:
-            continue
-        drug, path, p_value = line.strip().split('\t')[:3]
-        pathways.add(path)
-
-        if p_value == '[]' or float(p_value) > method_p_thresh:
-            continue
+    return np.array([path_index_dct[path] for path in rankings.path_lst],
+        dtype=int)
 
-        if drug not in corr_kw_path_dct:
-            corr_kw_path_dct[drug] = set([path])
-        else:
-            corr_kw_path_dct[drug].add(path)
-    corr_file.close()
-
-    return corr_kw_path_dct
-
-def get_embedding_path_dct(in_filename, method_p_thresh, corr_kw_path_dct):
+def get_corr_kw_p_matrix(corr_rankings, path_index_dct):
     '''
-    Given the correlation method path dictionary, find the top pathways for
-    each drug as computed by embedding, where the number of top pathways for
-    each drug is the same as the number as computed by correlation.
+    Returns the drugs x pathways matrix of the correlation method's p-values.
+    Pairs that are missing or have no p-value ('[]') are infinite, so they are
+    never below a threshold.
     '''
-    global pathways
-    method_drug_dct = {}
-    for drug in corr_kw_path_dct:
-        method_drug_dct[drug] = set([])
-
-    method_file = open(in_filename, 'r')
-    for i, line in enumerate(method_file):
-        if i < 2:
-            continue
-        drug, path, score = line.strip().split('\t')[:3]
-        pathways.add(path)
-        if score == '[]' or drug not in corr_kw_path_dct:
-            continue
-
-        # if drug not in method_drug_dct:
-        #     method_drug_dct[drug] = set([path])
-        # elif drug in method_drug_dct:
-        #     # Go to next path if we have reached the same number of paths as we
-        #     # have for the co-expression data.
-        if len(method_drug_dct[drug]) == len(corr_kw_path_dct[drug]):
-            continue
-        method_drug_dct[drug].add(path)
-    method_file.close()
-    return method_drug_dct
-
-def get_top_pathways(in_filename, method_p_thresh):
+    corr_p_matrix = np.full((len(corr_rankings.drug_lst), len(
+        path_index_dct)), np.inf)
+    is_scored = ~np.isnan(corr_rankings.scores)
+    path_codes = get_path_codes(corr_rankings, path_index_dct)
+    np.minimum.at(corr_p_matrix, (corr_rankings.drug_ids[is_scored],
+        path_codes[corr_rankings.path_ids[is_scored]]), corr_rankings.scores[
+        is_scored])
+    return corr_p_matrix
+
+def get_method_rank_matrix(corr_rankings, method_rankings, path_index_dct):
     '''
-    Returns a dictionary.
-    Each key is a drug. Each value is a set of paths associated with the drug.
-    If the in_filename is not the correlation pathway file, then we first
-    process that to get the number of pathways per drug. We keep only the top
-    k pathways per drug, where k is the same number of top pathways for the drug
-    via the correlation method.
+    Returns the drugs x pathways matrix of each pathway's position among the
+    drug's distinct scored pathways, in the method file's order. Unscored
+    pairs get the number of pathways, which no top pathway count exceeds. The
+    method's top k pathways for a drug are then the pathways of position below
+    k.
     '''
-    # Simply return the correlation dictionary if it's the desired method.
-    corr_kw_path_dct = get_corr_kw_path_dct(method_p_thresh)
+    method_rank_matrix = np.full((len(corr_rankings.drug_lst), len(
+        path_index_dct)), len(path_index_dct), dtype=int)
+    # Map the method file's drugs onto the correlation file's drugs.
+    drug_codes = np.array([corr_rankings.drug_index_dct.get(drug, -1) for
+        drug in method_rankings.drug_lst], dtype=int)
+    path_codes = get_path_codes(method_rankings, path_index_dct)
+    line_ids = np.nonzero(~np.isnan(method_rankings.scores) & (drug_codes[
+        method_rankings.drug_ids] >= 0))[0]
+    drug_ids = drug_codes[method_rankings.drug_ids[line_ids]]
+    path_ids = path_codes[method_rankings.path_ids[line_ids]]
+
+    # A repeated pathway does not take up another top pathway slot.
+    first_ids = np.sort(np.unique(drug_ids * len(path_index_dct) + path_ids,
+        return_index=True)[1])
+    drug_ids, path_ids = drug_ids[first_ids], path_ids[first_ids]
+    # Group by drug, keeping file order, and count from each drug's start.
+    order = np.argsort(drug_ids, kind='mergesort')
+    drug_ids, path_ids = drug_ids[order], path_ids[order]
+    method_rank_matrix[drug_ids, path_ids] = np.arange(len(drug_ids)) - (
+        np.searchsorted(drug_ids, drug_ids))
+    return method_rank_matrix
+
+def get_lincs_p_matrix(drug_index_dct, path_index_dct):
+    '''
+    Returns the drugs x pathways matrix of the LINCS p-values, infinite for
+    pairs that LINCS does not score.
+    '''
+    lincs_p_matrix = np.full((len(drug_index_dct), len(path_index_dct)),
+        np.inf)
+    for (drug, path), p_value in lincs_drug_path_dct.items():
+        if drug in drug_index_dct:
+            lincs_p_matrix[drug_index_dct[drug], path_index_dct[path]] = (
+                p_value)
+    return lincs_p_matrix
+
+def get_top_pathway_masks(in_filename, corr_rankings, method_rankings,
+    path_index_dct):
+    '''
+    Returns the method thresholds x drugs x pathways boolean array of the top
+    pathways of each drug. The correlation method keeps the pathways with
+    p-values below each threshold. Other methods keep, for each drug, as many
+    of their top pathways as the correlation method keeps.
+    Returns a pair (np.array(bool), np.array(bool)), the second being the
+    correlation method's masks, which decide which drugs are compared.
+    '''
+    corr_p_matrix = get_corr_kw_p_matrix(corr_rankings, path_index_dct)
+    corr_masks = corr_p_matrix <= np.array(p_thresh_range)[:, None, None]
     if in_filename == corr_kw_fname:
-        return corr_kw_path_dct
-    method_drug_dct = get_embedding_path_dct(in_filename, method_p_thresh,
-        corr_kw_path_dct)
-    return method_drug_dct
+        return corr_masks, corr_masks
+    method_rank_matrix = get_method_rank_matrix(corr_rankings,
+        method_rankings, path_index_dct)
+    num_top_paths = corr_masks.sum(axis=2)
+    return method_rank_matrix < num_top_paths[:, :, None], corr_masks
 
 def compare_methods(method, in_filename, out_filename):
     global pathways
+    # Read each ranking file once, instead of once per threshold.
+    corr_rankings = ranking_file.get_ranking_file(corr_kw_fname)
+    if in_filename == corr_kw_fname:
+        method_rankings = corr_rankings
+    else:
+        method_rankings = ranking_file.get_ranking_file(in_filename)
+    pathways.update(corr_rankings.path_lst, method_rankings.path_lst,
+        [path for drug, path in lincs_drug_path_dct])
+    path_index_dct = dict((path, i) for i, path in enumerate(sorted(
+        pathways)))
+
+    # Only drugs with pathways in the correlation method are compared, in
+    # order of first appearance in the correlation file.
+    drug_lst = corr_rankings.drug_lst
+    drug_index_dct = corr_rankings.drug_index_dct
+
+    # Thresholds x drugs x pathways.
+    method_masks, corr_masks = get_top_pathway_masks(in_filename,
+        corr_rankings, method_rankings, path_index_dct)
+    lincs_p_matrix = get_lincs_p_matrix(drug_index_dct, path_index_dct)
+    lincs_masks = lincs_p_matrix <= np.array(p_thresh_range)[:, None, None]
+
+    # Method thresholds x LINCS thresholds x drugs contingency tables.
+    lincs_and_res = np.einsum('mdp,ldp->mld', method_masks.astype(np.int32),
+        lincs_masks.astype(np.int32))
+    num_lincs = lincs_masks.sum(axis=2)[None, :, :]
+    num_res = method_masks.sum(axis=2)[:, None, :]
+    lincs_not_res = num_lincs - lincs_and_res
+    res_not_lincs = num_res - lincs_and_res
+    neither = len(pathways) - (num_lincs + num_res - lincs_and_res)
+    p_values = fisher_test.right_tail_p_values(lincs_and_res, num_lincs,
+        num_res, len(pathways))
+    # A drug is compared if it has correlation pathways and LINCS pathways.
+    is_compared = (corr_masks.any(axis=2)[:, None, :] & (num_lincs > 0))
 
     out = open(out_filename, 'w')
     out.write('method_p\tlincs_p\tdrug\tinter\tlincs\t%s' % method)
     out.write('\tneither\to_r\tfish-p\n')
-    # Results Processing
-    for method_p_thresh in p_thresh_range:
-        res_drug_dct = get_top_pathways(in_filename, method_p_thresh)
-
-        for lincs_p_thresh in p_thresh_range:
-            lincs_drug_dct = {}
-            for (drug, path) in lincs_drug_path_dct:
-                pathways.add(path)
-                if drug not in res_drug_dct:
-                    continue
-                if lincs_drug_path_dct[(drug, path)] <= lincs_p_thresh:
-                    if drug not in lincs_drug_dct:
-                        lincs_drug_dct[drug] = set([path])
-                    else:
-                        lincs_drug_dct[drug].add(path)
-
-            for drug in lincs_drug_dct:
-                lincs_below_p = lincs_drug_dct[drug]
-                res_below_p = res_drug_dct[drug]
-                lincs_and_res = len(lincs_below_p.intersection(res_below_p))
-                lincs_not_res = len(lincs_below_p.difference(res_below_p))
-                res_not_lincs = len(res_below_p.difference(lincs_below_p))
-                neither = len(pathways) - len(lincs_below_p.union(res_below_p))
-
-                f_table = ([[lincs_and_res, lincs_not_res],
-                    [res_not_lincs, neither]])
-                o_r, p_val = fisher_exact(f_table, alternative='greater')
-
+    for method_i, method_p_thresh in enumerate(p_thresh_range):
+        for lincs_i, lincs_p_thresh in enumerate(p_thresh_range):
+            for drug_i in np.nonzero(is_compared[method_i, lincs_i])[0]:
+                table_i = (method_i, lincs_i, drug_i)
                 out.write('%f\t%f\t%s\t%d\t%d\t' % (method_p_thresh,
-                    lincs_p_thresh, drug, lincs_and_res, lincs_not_res))
-                out.write('%d\t%d\t%g\n' % (res_not_lincs, neither, p_val))
+                    lincs_p_thresh, drug_lst[drug_i], lincs_and_res[table_i],
+                    lincs_not_res[table_i]))
+                out.write('%d\t%d\t%g\n' % (res_not_lincs[table_i],
+                    neither[table_i], p_values[table_i]))
     out.close()
 
 def main():
@@ -1,6 +1,9 @@
 ### Author: Edward Huang
 
+import numpy as np
 import operator
+import os
+import ranking_file
 import time
 
 ### This script compares the 10k runs of random embedding to the proper run of
@@ -10,23 +13,35 @@ import time
 
 def read_random_top_pathways():
     '''
-    Returns a dictionary.
-    Key: str -> pathway name.
-    Value: [floats] -> cosine scores from random embedding experiment..
+    Returns a (list, matrix) pair.
+    list: pathway names -> list(str)
+    matrix: each row holds a pathway's cosine scores from the random embedding
+        experiment, sorted in increasing order -> np.array
+    The binary null file written by random_embedding_top_pathways.py is read
+    if it exists. Otherwise the scores are parsed from the text file.
     '''
-    random_pathway_dct = {}
     subfolder = './results/random_embedding/'
-    f = open('%srandom_ppi_top_pathways_50_0.8.U_top_250.txt' % subfolder, 'r')
+    fname = '%srandom_ppi_top_pathways_50_0.8.U_top_250' % subfolder
+    if os.path.exists(fname + '.null.npz'):
+        null_npz = np.load(fname + '.null.npz')
+        path_lst = null_npz['path_lst'].tolist()
+        null_score_matrix = null_npz['null_score_matrix']
+        null_npz.close()
+        return path_lst, null_score_matrix
+
+    path_lst, null_score_lst = [], []
+    f = open(fname + '.txt', 'r')
     for i, line in enumerate(f):
         if i < 2:
             continue
         line = line.strip().split('\t')
-        pathway, cosine_scores = line[0], map(float, line[1:])
+        pathway, cosine_scores = line[0], np.array(line[1:], dtype=float)
 
-        assert pathway not in random_pathway_dct
-        random_pathway_dct[pathway] = cosine_scores
+        assert pathway not in path_lst
+        path_lst += [pathway]
+        null_score_lst += [np.sort(cosine_scores)]
     f.close()
-    return random_pathway_dct
+    return path_lst, np.array(null_score_lst)
 
 def get_embedding_path_dct():
     '''
@@ -34,38 +49,45 @@ def get_embedding_path_dct():
     each drug as computed by embedding, where the number of top pathways for
     each drug is the same as the number as computed by correlation.
     '''
-    embedding_path_dct = {}
-
-    f = open('./results/random_embedding/ppi_top_pathways_50_0.8.U_top_250_just_cosine.txt', 'r')
-    for i, line in enumerate(f):
-        if i < 2:
-            continue
-        drug, path, score = line.strip().split('\t')
-        if score == '[]':
-            continue
-
-        assert (drug, path) not in embedding_path_dct
-        embedding_path_dct[(drug, path)] = float(score)
-    f.close()
+    embedding_rankings = ranking_file.get_ranking_file('./results/' +
+        'random_embedding/ppi_top_pathways_50_0.8.U_top_250_just_cosine.txt')
+    line_ids = np.nonzero(~np.isnan(embedding_rankings.scores))[0]
+    drug_path_lst = embedding_rankings.get_pairs(line_ids)
+    embedding_path_dct = dict(zip(drug_path_lst, embedding_rankings.scores[
+        line_ids].tolist()))
+    assert len(embedding_path_dct) == len(drug_path_lst)
     return embedding_path_dct
 
-def get_p_value_dct(random_pathway_dct, embedding_path_dct):
+def get_p_value_dct(path_lst, null_score_matrix, embedding_path_dct):
     '''
     Returns a dictionary.
     Key: (str, str) -> (drug, pathway)
-    Value: int -> number of random cosine scores out of 10k better than the 
+    Value: float -> fraction of the random cosine scores better than the
             netpath score for the same key.
+    Each pathway's sorted random scores answer all of its netpath scores with
+    one binary search.
     '''
-    netpath_p_value_dct = {}
-    for (drug, path) in embedding_path_dct:
-        random_cosine_scores = random_pathway_dct[path]
-        netpath_score = embedding_path_dct[(drug, path)]
-        num_better = sum(i > netpath_score for i in random_cosine_scores)
-        
-        assert (drug, path) not in netpath_p_value_dct
-        netpath_p_value_dct[(drug, path)] = num_better / float(len(
-            random_cosine_scores))
-    return netpath_p_value_dct 
+    path_index_dct = dict((path, i) for i, path in enumerate(path_lst))
+    drug_path_lst = list(embedding_path_dct)
+    path_indices = np.array([path_index_dct[path] for (drug, path) in
+        drug_path_lst], dtype=int)
+    netpath_scores = np.array([embedding_path_dct[drug_path] for drug_path in
+        drug_path_lst])
+
+    num_random = null_score_matrix.shape[1]
+    num_better = np.zeros(len(drug_path_lst), dtype=int)
+    # Group the pairs by pathway once. Each pathway's pairs are then the slice
+    # of order between its offsets in path_indptr.
+    order = np.argsort(path_indices, kind='mergesort')
+    path_counts = np.bincount(path_indices, minlength=len(path_lst))
+    path_indptr = np.concatenate(([0], np.cumsum(path_counts)))
+    for path_i in np.nonzero(path_counts)[0]:
+        pairs = order[path_indptr[path_i]:path_indptr[path_i + 1]]
+        # Random scores strictly greater than each netpath score.
+        num_better[pairs] = num_random - np.searchsorted(null_score_matrix[
+            path_i], netpath_scores[pairs], side='right')
+
+    return dict(zip(drug_path_lst, (num_better / float(num_random)).tolist()))
 
 def write_out_netpath_p_values(netpath_p_value_dct):
     '''
@@ -80,9 +102,9 @@ def write_out_netpath_p_values(netpath_p_value_dct):
     out.close()
 
 def main():
-    random_pathway_dct = read_random_top_pathways()
+    path_lst, null_score_matrix = read_random_top_pathways()
     embedding_path_dct = get_embedding_path_dct()
-    netpath_p_value_dct = get_p_value_dct(random_pathway_dct,
+    netpath_p_value_dct = get_p_value_dct(path_lst, null_score_matrix,
         embedding_path_dct)
     write_out_netpath_p_values(netpath_p_value_dct)
 
@@ -1,10 +1,13 @@
 ### Author: Edward Huang
 
+import argparse
 import file_operations
+from multiprocessing import Pool
 import numpy as np
 import operator
-from scipy.stats.mstats import kruskalwallis
+import pathway_index
 import time
+import tsv_writer
 
 ### Find the top genes for each drug from gene expression.
 ### Uses Kruskal-Wallis instead of Fisher's test to then use the gene rankings
@@ -14,76 +17,79 @@ import time
 # This variable is for counting purposes, only.
 KRUSKAL_P_THRESH = 0.05
 
-def get_gene_drug_correlations(drug, drug_response_vector, gene_expression_dct):
+def get_gene_drug_correlations(drug, drug_response_vector):
     '''
-    Returns a dictionary.
+    Correlates the drug with every gene in the shared gene expression matrix,
+    over the patients that have a response to the drug. The drug's NA mask
+    selects the patients, so neither the drug response vector nor the shared
+    matrix are modified. Returns a (dictionary, np.array) pair.
     Each key is a (gene, drug, Pearson correlation) triple.
     Each value is the p-value corresponding to the correlation in the key.
+    np.array: the p-values in the order of gene_lst -> np.array
     '''
-    # Indices of None values in our drug response table.
-    NA_i = [i for i, e in enumerate(drug_response_vector) if e == None]
-    NA_i.reverse()
-
-    gene_map_list = gene_expression_dct.keys()
-    gene_expression_mat = gene_expression_dct.values()
-    # Delete None elements in the drug response and gene expression vectors.
-    for index in NA_i:
-        del drug_response_vector[index]
-        for i, row in enumerate(gene_expression_mat):
-            del row[index]
-
-    if len(drug_response_vector) == 0:
-        return {}
-
-    r = file_operations.generate_correlation_map(np.array(
-        [drug_response_vector]), np.array(gene_expression_mat))
-    num_valid_patients = len(drug_response_vector)
-    p = [file_operations.compute_p_val(pcc, num_valid_patients) for pcc in r]
-
-    gene_drug_correlation_dct = {}
-    for i, gene in enumerate(gene_map_list):
-        pcc, p_value = r[i], p[i]
-        # We keep all p-values here because KW needs them. correlation_top_
-        # pathways.py has a threshold because of Fisher's test.
-        gene_drug_correlation_dct[(gene, drug, pcc)] = p_value
-    return gene_drug_correlation_dct
-
-def get_drug_path_kw_dct(drug, nci_path_dct, corr_gene_dct,
-    gene_expression_dct):
+    # Patients with a drug response.
+    is_valid = np.array([e != None for e in drug_response_vector])
+    if not is_valid.any():
+        return {}, None
+
+    drug_response_vector = np.array([e for e in drug_response_vector if e !=
+        None], dtype=float)
+    r, num_valid_patients = file_operations.get_pearson_matrices(
+        drug_response_vector[np.newaxis], gene_expression_mat[:, is_valid])
+    r = r[0]
+    p = file_operations.compute_p_vals(r, num_valid_patients[0, 0])
+
+    # We keep all p-values here because KW needs them. correlation_top_
+    # pathways.py has a threshold because of Fisher's test.
+    gene_drug_correlation_dct = dict(((gene, drug, r[i]), p[i]) for i, gene in
+        enumerate(gene_lst))
+    return gene_drug_correlation_dct, p
+
+def get_path_member_indices(gene_lst):
     '''
+    Returns a (list, np.array, np.array) tuple.
+    list: NCI pathways -> list(str)
+    np.array_0: indices in gene_lst of the genes of every pathway, pathway
+        after pathway -> np.array(int)
+    np.array_1: index in the list of the pathway of each member -> np.array(int)
+    Genes in NCI pathways but not in gene_lst are skipped.
+    '''
+    path_index = pathway_index.get_pathway_index()
+    path_matrix = path_index.get_membership_matrix(gene_lst)
+    member_path_ids = np.repeat(np.arange(len(path_index.path_lst)), np.diff(
+        path_matrix.indptr))
+    return path_index.path_lst, path_matrix.indices, member_path_ids
+
+def get_drug_path_kw_dct(drug, path_lst, member_indices, member_path_ids,
+    corr_p_values):
+    '''
+    Runs the Kruskal-Wallis test of every pathway's gene p-values against the
+    other genes' p-values for one drug. corr_p_values are the drug's gene
+    p-values, and the pathway members are given by get_path_member_indices.
+    The p-values are ranked once, and each pathway's rank sum is a bincount
+    over its members, so all pathways are tested in one vectorized step.
     Returns a (dict, int) pair.
-    Key: (drug, path) tuple -> (str, str)
+    Key: (drug, path, h_stat) tuple -> (str, str, float)
     Value: p-value corresponding to Kruskal-Wallis test -> float
 
     The int counts the number of drug-pathway pairs that have p-value below 
     KRUSKAL_P_THRESH.
     '''
-    drug_path_p_values, num_low_p = {}, 0
-
-    # Compute the top pathways for each drug with the Kruskal-Wallis test.
-    for path in nci_path_dct:
-        # Make a copy of drug-gene correlations and then remove the genes
-        # that are in each pathway.
-        non_pathway_correlations = corr_gene_dct.copy()
-        pathway_correlations = []
-        path_genes = nci_path_dct[path]
-        # Split the correlations into genes in the pathways and genes that
-        # aren't.
-        for gene in path_genes:
-            # Skip genes in NCI pathways but not in gene expression data.
-            if gene not in gene_expression_dct:
-                continue
-            pathway_correlations += [non_pathway_correlations[gene]]
-            del non_pathway_correlations[gene]
-
-        non_pathway_correlations = non_pathway_correlations.values()
-        h_stat, p_value = kruskalwallis(pathway_correlations,
-            non_pathway_correlations)
-        drug_path_p_values[(drug, path, h_stat)] = p_value
-
-        if p_value < KRUSKAL_P_THRESH:
-            num_low_p += 1
-
+    rank_matrix, tie_sums = file_operations.get_rank_matrix(
+        corr_p_values[np.newaxis])
+    ranks = rank_matrix[0]
+    # Undefined p-values are left out of both groups.
+    is_valid = np.isfinite(corr_p_values)
+    rank_sums = np.bincount(member_path_ids, weights=ranks[member_indices],
+        minlength=len(path_lst))
+    path_sizes = np.bincount(member_path_ids, weights=is_valid[
+        member_indices], minlength=len(path_lst))
+
+    h_stats, p_values = file_operations.compute_kruskal_wallis(rank_sums,
+        path_sizes, is_valid.sum(), tie_sums[0])
+    drug_path_p_values = dict(((drug, path, h_stats[path_i]), p_values[path_i])
+        for path_i, path in enumerate(path_lst))
+    num_low_p = int((p_values < KRUSKAL_P_THRESH).sum())
     return drug_path_p_values, num_low_p
 
 def write_gene_drug_correlations(gene_drug_correlations):
@@ -91,13 +97,13 @@ def write_gene_drug_correlations(gene_drug_correlations):
     Write to file all significant gene-drug correlations and their p-values.
     '''
     # Sort the top genes by value. Get the top genes.
-    gene_out = open('./results/correlation_top_genes_kw.txt', 'w')
+    gene_out = tsv_writer.TsvWriter('./results/correlation_top_genes_kw.txt')
     gene_out.write('gene\tdrug\tcorrelation\tp_value\n')
     # gene_out.write('gene\tdrug\tcorrelation\n')
     gene_drug_correlations = sorted(gene_drug_correlations.items(),
         key=operator.itemgetter(1))
-    for (gene, drug, pcc), p_value in gene_drug_correlations:
-        gene_out.write('%s\t%s\t%f\t%g\n' % (gene, drug, pcc, p_value))
+    gene_out.write_rows('%s\t%s\t%f\t%g\n', ((gene, drug, pcc, p_value) for
+        (gene, drug, pcc), p_value in gene_drug_correlations))
     gene_out.close()
 
 def write_drug_path_correlations(drug_path_p_values, num_low_p):
@@ -108,55 +114,82 @@ def write_drug_path_correlations(drug_path_p_values, num_low_p):
     top_paths = sorted(drug_path_p_values.items(), key=operator.itemgetter(1))
 
     # Write out the results.
-    path_out = open('./results/correlation_top_pathways_kw.txt', 'w')
+    path_out = tsv_writer.TsvWriter('./results/correlation_top_pathways_kw.txt')
     path_out.write('num_below_%f\t%d\n' % (KRUSKAL_P_THRESH, num_low_p))
     path_out.write('drug\tpath\tp_value\th_statistic\n')    
-    for (drug, path, h_stat), p_val in top_paths:
-        path_out.write('%s\t%s\t%g\t%g\n' % (drug, path, p_val, h_stat))
+    path_out.write_rows('%s\t%s\t%g\t%g\n', ((drug, path, p_val, h_stat) for
+        (drug, path, h_stat), p_val in top_paths))
     path_out.close()
 
+def score_drug(drug):
+    '''
+    Correlates one drug with every gene, then runs the Kruskal-Wallis test of
+    every pathway. Uses the globals set by write_top_pathways, which forked
+    workers share. Returns a (dict, dict, int) tuple of the drug's gene-drug
+    correlations, its drug-pathway p-values and the number of low p-values.
+    '''
+    gene_drug_correlation_dct, corr_p_values = get_gene_drug_correlations(
+        drug, drug_response_dct[drug])
+    if gene_drug_correlation_dct == {}:
+        return {}, {}, 0
+
+    drug_path_p_values, num_low_p = get_drug_path_kw_dct(drug, path_lst,
+        member_indices, member_path_ids, corr_p_values)
+    return gene_drug_correlation_dct, drug_path_p_values, num_low_p
+
 def write_top_pathways():
     '''
     The main function.
     '''
-    nci_path_dct, nci_genes = file_operations.get_nci_path_dct()
+    global drug_response_dct, gene_expression_mat, gene_lst
+    global path_lst, member_indices, member_path_ids
     drug_response_dct = file_operations.get_drug_response_dct()
+    # The gene expression matrix is read once, and never modified.
+    gene_df = file_operations.get_gene_df('gene_expression_hgnc.tsv')
+    gene_lst = list(gene_df.index)
+    gene_expression_mat = np.asarray(gene_df.values)
+    gene_expression_mat.flags.writeable = False
 
     gene_drug_correlations = {}
     # Key: (drug, path, h-statistic). Value: p-value of KW test between drug's
     # correlated genes and path's correlated genes.
     drug_path_p_values = {}
     # Counts the number of drug-pathway pairs with KW p-value KRUSKAL_P_THRESH.
-    num_low_p, num_drugs = 0, float(len(drug_response_dct))
-
-    for drug in drug_response_dct:
-        # Fetch this repeatedly because of deep copy issues with del.
-        gene_expression_dct = file_operations.get_gene_expression_dct()
-        
-        drug_response_vector = drug_response_dct[drug]
-
-        gene_drug_correlation_dct = get_gene_drug_correlations(drug,
-            drug_response_vector, gene_expression_dct)
-
-        if gene_drug_correlation_dct == {}:
-            continue
-
+    num_low_p = 0
+
+    # The pathways' members among the genes of the expression data.
+    path_lst, member_indices, member_path_ids = get_path_member_indices(
+        gene_lst)
+
+    # Workers are forked after the shared inputs are loaded, so they share
+    # them instead of reading them again.
+    if args.num_workers > 1:
+        pool = Pool(processes=args.num_workers)
+        results = pool.imap(score_drug, drug_response_dct)
+    else:
+        results = (score_drug(drug) for drug in drug_response_dct)
+
+    for (gene_drug_correlation_dct, curr_drug_path_p_values,
+        curr_num_low_p) in results:
         gene_drug_correlations.update(gene_drug_correlation_dct)
-
-        corr_gene_dct = {}
-        for (gene, drug, pcc) in gene_drug_correlation_dct:
-            corr_gene_dct[gene] = gene_drug_correlations[(gene, drug, pcc)]
-
-        curr_drug_path_p_values, curr_num_low_p = get_drug_path_kw_dct(drug,
-            nci_path_dct, corr_gene_dct, gene_expression_dct)
-
         drug_path_p_values.update(curr_drug_path_p_values)
         num_low_p += curr_num_low_p
+    if args.num_workers > 1:
+        pool.close()
+        pool.join()
 
     write_drug_path_correlations(drug_path_p_values, num_low_p)
     write_gene_drug_correlations(gene_drug_correlations)
 
+def parse_args():
+    global args
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--num_workers', type=int, default=1,
+        help='Number of drugs to score in parallel.')
+    args = parser.parse_args()
+
 def main():
+    parse_args()
     write_top_pathways()
 
 if __name__ == '__main__':
@@ -2,14 +2,14 @@
 
 import argparse
 import file_operations
-from multiprocessing import Pool
 import numpy as np
 import operator
 import pandas as pd
 from pandas._libs import algos as libalgos
-from scipy.stats import fisher_exact, pearsonr
+from scipy.stats import fisher_exact
 # import sys
 import time
+import tsv_writer
 
 ### For each drug, find the k most correlated genes, where k is the command line
 ### argument. Write this out to file. Then, for each drug, find the pathways
@@ -40,104 +40,72 @@ def rename_cols(dr_df, gene_df):
 
     return dr_df, gene_df
 
-# def get_gene_drug_pearson_dct(drug, dr_vector, gene_expr_mat, gene_list):
-def get_gene_drug_pearson_dct(drug):
+def get_sort_key(pcc_arr, p_val_arr):
     '''
-    Returns a dictionary. Each value is the p-value corresponding to the
-    correlation in the key. Only records correlations with p-value below
-    pearson_thresh.
-    Key: (gene, drug, Pearson correlation) -> (str, str, float)
-    Value: p-value -> float
+    Returns the array whose ascending order is the order genes are written out
+    in for a drug. Highest correlations first for sortCorr, otherwise lowest
+    p-values first.
     '''
-    # drug = dr_vector.index.values[0]
-    dr_vector = dr_df.loc[[drug]]
+    if args.sort_value == 'sortCorr':
+        return -pcc_arr
+    return p_val_arr
 
-    # Get the pairwise column correlations.
-    # corr_mat = pd.concat([dr_vector, gene_df]).transpose()
-    
-    # Get the values of the drug row. Remove first element, because it's the
-    # self correlation.
-    # print corr_mat.corr().loc[[drug]]['BRAF']
-    # exit()
-    # corr_values = corr_mat.corr().loc[[drug]].values[0][1:]
-    # corr_values = corr_mat.corr().loc[[drug]]
-    # print corr_values
-
-    # num_samples = len(list(gene_df))
-    num_genes, num_samples = gene_df.shape
-    # print list(gene_df)
-    # p = [file_operations.compute_p_val(pcc, num_samples) for pcc in corr_values]
-    # print np.array(p)
-    # exit() # TODO
-
-    # num_genes = len(gene_df.index.values)
-    # Get list of bad sample names.
-    # bad_dr_sample_lst = dr_vector.columns[dr_vector.isna().any()].tolist()
-
-    gene_drug_pearson_dct = {}
-    # for gene, row in gene_df.iterrows():
-    for gene in gene_df.index.values:
-        drug_gene_df = pd.concat([dr_vector, gene_df.loc[[gene]]]).transpose().dropna()
-        pcc, p_value = pearsonr(drug_gene_df[drug], drug_gene_df[gene])
-
-        # bad_ge_sample_lst = [sample for sample in row.axes[0] if pd.isnull(row[sample])]
-        # ge_vector = gene_df.loc[[gene]]
-        # bad_ge_sample_lst = ge_vector.columns[ge_vector.isna().any()].tolist()
-        # bad_samples_both = set(bad_dr_sample_lst).union(bad_ge_sample_lst)
-
-        # num_good_samples = num_samples - len(bad_samples_both)
-
-        # pcc = corr_values[gene].values[0]
-        # p_value = file_operations.compute_p_val(pcc, num_good_samples)
-        # p_value = pval[p_count]
-
-        # if gene == 'BRAF':
-        #     print gene, drug, pcc, p_value * num_genes
-        #     exit()
-        # filtered_dr = np.array(dr_vector.drop(bad_samples_both, axis=1))[0]
-        # filtered_row = np.array(row.drop(bad_samples_both))
-
-        # # pcc, p_value = pearsonr(filtered_dr, filtered_row)
-        p_value *= num_genes
-        if p_value < args.pearson_thresh:
-            if args.sort_value == 'sortCorr':
-                gene_drug_pearson_dct[(gene, drug)] = pcc
-            else:
-                gene_drug_pearson_dct[(gene, drug, pcc)] = p_value
-    return gene_drug_pearson_dct
-
-    #     # bad_ge_sample_lst = row.columns[row.isna().any()].tolist()
-    #     # print bad_ge_sample_lst
-    # # Drop bad samples from drug response vector.
-    # dr_matrix = np.array(dr_vector.drop(bad_dr_sample_lst, axis=1))
-    # # Drop bad samples from gene expression matrix.
-    # ge_matrix = np.array(gene_expr_df.drop(bad_dr_sample_lst, axis=1))
-    # # # Indices of -666 patients in the drug response.
-    # # good_indices = np.where(dr_vector != -666)[0]
-
-    # # Delete -666 drug response patients from both matrices.
-    # # sliced_dr = np.array([dr_vector[good_indices]]) # Convert to matrix.
-    # # sliced_mat = gene_expr_mat[:,good_indices]
-
-    # # Compute the correlation between the DR vector and every expression vector.
-    # r = file_operations.generate_correlation_map(dr_matrix, ge_matrix)
-    # # r = file_operations.generate_correlation_map(sliced_dr, sliced_mat)
-    # # Get the corresponding p-value for each Pearson correlation coefficient.
-    # # Number of good indices?
-    # p = [file_operations.compute_p_val(pcc, len(dr_matrix[0])) for pcc in r]
-
-    # gene_list = gene_expr_df.index.values
-    # # Build the dictionary mapping gene-drug pairs to their correlation p-value.
-    # gene_drug_pearson_dct = {}
-    # for i, gene in enumerate(gene_list):
-    #     # Multiplying by length of gene list to do Bonferroni correction.
-    #     pcc, p_value = r[i], p[i] * len(gene_list)
-    #     if p_value < args.pearson_thresh:
-    #         if args.sort_value == 'sortCorr':
-    #             gene_drug_pearson_dct[(gene, drug)] = pcc
-    #         else:
-    #             gene_drug_pearson_dct[(gene, drug, pcc)] = p_value
-    # return gene_drug_pearson_dct
+def get_drug_top_genes_lst():
+    '''
+    Streams the drug-gene correlations batch by batch, and keeps for each drug
+    only the genes that get written out: every gene with Bonferroni-corrected
+    p-value below pearson_thresh, or only the best top_k of them if top_k is
+    set. Returns a (list, np.array) pair.
+    list: for each drug in dr_df, a (gene indices, correlations, p-values)
+        triple, sorted in output order -> list((np.array, np.array, np.array))
+    np.array: number of significant genes for each drug -> np.array(int)
+    '''
+    num_genes, num_drugs = gene_df.shape[0], dr_df.shape[0]
+
+    if args.input_file == 'ge':
+        # Gene expression has no missing values, so all genes fit in one batch.
+        r_mat, num_samples = file_operations.get_pearson_matrices(
+            dr_df.values, gene_df.values)
+        batches = [(0, r_mat, num_samples)]
+    else:
+        # Essentiality screens have missing values in both matrices.
+        batches = file_operations.get_pairwise_pearson_batches(dr_df.values,
+            gene_df.values)
+
+    drug_top_genes_lst = [(np.array([], dtype=int), np.array([]), np.array(
+        [])) for drug_i in range(num_drugs)]
+    num_dcg_arr = np.zeros(num_drugs, dtype=int)
+    for start, r_mat, num_samples in batches:
+        # Multiplying by number of genes to do Bonferroni correction.
+        p_mat = file_operations.compute_p_vals(r_mat, num_samples) * num_genes
+        with np.errstate(invalid='ignore'):
+            significant_mat = p_mat < args.pearson_thresh
+        num_dcg_arr += significant_mat.sum(axis=1)
+
+        for drug_i in np.nonzero(significant_mat.any(axis=1))[0]:
+            batch_indices = np.nonzero(significant_mat[drug_i])[0]
+            # Merge the batch's significant genes with the ones kept so far.
+            gene_indices, pcc_arr, p_val_arr = drug_top_genes_lst[drug_i]
+            gene_indices = np.concatenate((gene_indices, start +
+                batch_indices))
+            pcc_arr = np.concatenate((pcc_arr, r_mat[drug_i, batch_indices]))
+            p_val_arr = np.concatenate((p_val_arr, p_mat[drug_i,
+                batch_indices]))
+            # Partial selection of the best top_k genes for the drug.
+            if args.top_k != None and len(gene_indices) > args.top_k:
+                best = np.sort(np.argpartition(get_sort_key(pcc_arr,
+                    p_val_arr), args.top_k - 1)[:args.top_k])
+                gene_indices = gene_indices[best]
+                pcc_arr, p_val_arr = pcc_arr[best], p_val_arr[best]
+            drug_top_genes_lst[drug_i] = (gene_indices, pcc_arr, p_val_arr)
+
+    # Sort each drug's kept genes in output order.
+    for drug_i, (gene_indices, pcc_arr, p_val_arr) in enumerate(
+        drug_top_genes_lst):
+        order = np.argsort(get_sort_key(pcc_arr, p_val_arr), kind='mergesort')
+        drug_top_genes_lst[drug_i] = (gene_indices[order], pcc_arr[order],
+            p_val_arr[order])
+    return drug_top_genes_lst, num_dcg_arr
 
 # def get_drug_path_fisher_dct(drug, gene_universe, corr_genes, path_to_gene_dct):
 #     '''
@@ -190,48 +158,53 @@ def get_gene_drug_pearson_dct(drug):
 #             inter, corr_len, path_len, neither))
 #     path_out.close()
 
-def write_gene_drug_pearson_dct(gene_drug_pearson_dct):
+def write_gene_drug_pearson_file(drug_top_genes_lst):
     '''
-    Write to file all significant gene-drug correlations and their p-values.
+    Write to file all significant gene-drug correlations and their p-values,
+    grouped by drug. Also writes a .idx file with each drug's byte offset and
+    number of lines, so readers can seek straight to a drug.
     '''
-    # Sort the top genes by value. Get the top genes.
-    reverse = args.sort_value == 'sortCorr'
-    sorted_pearson_dct = sorted(gene_drug_pearson_dct.items(),
-        key=operator.itemgetter(1), reverse=reverse)
-
-    gene_out = open('./results/%s_gene_drug_pearson_%s_%g.txt' % (args.input_file,
-        args.sort_value, args.pearson_thresh), 'w')
-    # gene_out.write('gene\tdrug\tpearson_correlation\tp_value\n')
+    gene_list, drug_list = gene_df.index.values, dr_df.index.values
+
+    out_fname = './results/%s_gene_drug_pearson_%s_%g.txt' % (args.input_file,
+        args.sort_value, args.pearson_thresh)
+    gene_out = tsv_writer.TsvWriter(out_fname)
+    index_out = tsv_writer.TsvWriter('%s.idx' % out_fname)
     gene_out.write('gene\tdrug\tpearson_correlation\tp_value\n')
-    # for (gene, drug, pcc), p_value in gene_drug_pearson_dct:
-    #     gene_out.write('%s\t%s\t%g\t%g\n' % (gene, drug, pcc, p_value))
-    if args.sort_value == 'sortCorr':
-        for (gene, drug), pcc in sorted_pearson_dct:
-            gene_out.write('%s\t%s\t%g\n' % (gene, drug, pcc))
-    else:
-        for (gene, drug, pcc), p_val in sorted_pearson_dct:
-            gene_out.write('%s\t%s\t%g\t%g\n' % (gene, drug, pcc, p_val))
+    for drug_i, (gene_indices, pcc_arr, p_val_arr) in enumerate(
+        drug_top_genes_lst):
+        if len(gene_indices) == 0:
+            continue
+        drug = drug_list[drug_i]
+        index_out.write('%s\t%d\t%d\n' % (drug, gene_out.tell(),
+            len(gene_indices)))
+        drug_column = [drug] * len(gene_indices)
+        if args.sort_value == 'sortCorr':
+            gene_out.write_columns('%s\t%s\t%g\n', [gene_list[gene_indices],
+                drug_column, pcc_arr])
+        else:
+            gene_out.write_columns('%s\t%s\t%g\t%g\n', [gene_list[
+                gene_indices], drug_column, pcc_arr, p_val_arr])
+    # The index is only renamed into place once the gene file is complete.
     gene_out.close()
+    index_out.close()
 
-def write_num_dcg(gene_drug_pearson_dct):
+def write_num_dcg(num_dcg_arr):
     '''
     For each drug, write the number of highly correlated genes.
     '''
-    dcg_count_dct = {}
-    for key in gene_drug_pearson_dct:
-        gene, drug, pcc = key
-        # Initialize a drug not in the dictionary.
-        if drug not in dcg_count_dct:
-            dcg_count_dct[drug] = 0
-        dcg_count_dct[drug] += 1
-    sorted_dcg_count_dct = sorted(dcg_count_dct.items(), key=operator.itemgetter(1),
-        reverse=True)
+    drug_list = dr_df.index.values
+    # Drugs with the most correlated genes first.
+    sorted_drug_indices = np.argsort(-num_dcg_arr, kind='mergesort')
 
     # Write out the file. # TODO: Change output name for each metohd. Same with regular thinig.
     out = open('./results/%s_drug_dcg_counts_%g.txt' % (args.input_file,
         args.pearson_thresh), 'w')
-    for drug, count in sorted_dcg_count_dct:
-        out.write('%s\t%d\n' % (drug, count))
+    for drug_i in sorted_drug_indices:
+        # Only drugs with at least one correlated gene.
+        if num_dcg_arr[drug_i] == 0:
+            break
+        out.write('%s\t%d\n' % (drug_list[drug_i], num_dcg_arr[drug_i]))
     out.close()
 
 def parse_args():
@@ -243,6 +216,9 @@ def parse_args():
         required=True, choices=['sortCorr', 'sortP'])
     parser.add_argument('-p', '--pearson_thresh', required=True, type=float,
         help='Pearson threshold that determines a significant correlation.')
+    parser.add_argument('-k', '--top_k', type=int, default=None,
+        help='Number of most correlated genes to keep for each drug. Keeps '
+        'every significant gene if not set.')
     args = parser.parse_args()
 
 def main():
@@ -288,14 +264,7 @@ def main():
 
     # Dictionaries to write out to file.
     # gene_drug_pearson_dct, drug_path_fisher_dct = {}, {}
-    gene_drug_pearson_dct = {}
-
-    pool = Pool(processes=20)
-    dcts = pool.map(get_gene_drug_pearson_dct, dr_df.index.values)
-    pool.close()
-    pool.join()
-    for dct in dcts:
-        gene_drug_pearson_dct.update(dct)
+    drug_top_genes_lst, num_dcg_arr = get_drug_top_genes_lst()
     # # for drug in drug_to_dr_dct:
     # for drug in dr_df.index.values:
     #     # dr_vector = drug_to_dr_dct[drug]
@@ -329,10 +298,10 @@ def main():
 
     # Write dictionaries out to file.
     # write_drug_path_correlations(drug_path_fisher_dct, num_low_p)
-    write_gene_drug_pearson_dct(gene_drug_pearson_dct)
+    write_gene_drug_pearson_file(drug_top_genes_lst)
 
     # For each drug, get the number of correlated genes.
-    write_num_dcg(gene_drug_pearson_dct)
+    write_num_dcg(num_dcg_arr)
 
 if __name__ == '__main__':
     start_time = time.time()
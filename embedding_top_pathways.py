@@ -3,12 +3,14 @@
 # from collections import OrderedDict
 import argparse
 import file_operations
+from multiprocessing import Pool
 import numpy as np
-import operator
 import os
-from scipy import linalg
+from scipy import linalg, sparse
 import sys
 import time
+import traceback
+import tsv_writer
 
 ### For each drug, we take the top K most correlated genes, as computed by the
 ### drug_pathway_fisher_correlation.py script. Then, for each drug-pathway pair,
@@ -16,133 +18,134 @@ import time
 ### drug with the gene-pathway cosine similarity scores.
 ### Run time: 6 minutes per embedding file.
 
-# def get_embedding_dct(dimension, suffix, fraction, emb_node_lst, all_genes,
-#     path_to_gene_dct):
-def get_embedding_dct(filename, emb_node_lst, all_genes, path_to_gene_dct):
+def get_unit_vector_matrix(emb_mat, node_index_dct, node_lst):
     '''
-    Returns a dictionary.
-    Key: node (either a gene or a pathway) -> str
-    Value: key's corresponding embedding vector -> list(float)
+    Returns the matrix of embedding vectors for the nodes in node_lst (either
+    genes or pathways), each scaled to unit length, so that dot products
+    between rows are cosine similarities.
     '''
-    node_embedding_dct = {}
+    vector_matrix = file_operations.get_node_vectors(emb_mat, node_index_dct,
+        node_lst)
+    return vector_matrix / linalg.norm(vector_matrix, axis=1)[:, np.newaxis]
 
-    # if isPpi:
-    #     data_folder = './data/embedding' # With PPI.
-    #     filename = '%s/ppi_6_net_%s_%s.%s' % (data_folder, dimension, fraction,
-    #         suffix)
-    # else:
-    #     data_folder = './embedding' # string_experimental
-    #     filename = '%s/string_experimental_%s_%s.%s' % (data_folder, dimension,
-    #     fraction, suffix)
-
-    f = open(filename, 'r')
-    for i, line in enumerate(f):
-        # Each row in the file maps to the row in gene_pathway_id.txt.
-        node = emb_node_lst[i]
-        # Skip genes and pathways that are in neither expression or NCI pathways.
-        if (node not in all_genes) and (node not in path_to_gene_dct):
-            continue
-        # Convert lines to floats.
-        assert node not in node_embedding_dct
-        node_embedding_dct[node] = map(float, line.split())
-    f.close()
-    return node_embedding_dct
-
-def create_embedding_matrix(node_list, node_embedding_dct):
+def get_drug_gene_corr_matrix(drug_lst, gene_lst, drug_corr_genes_dct):
+    '''
+    Returns a sparse D x G matrix. Entry (i, j) is the correlation between
+    drug_lst[i] and gene_lst[j] if the gene is one of the drug's top
+    correlated genes, and 0 otherwise.
+    '''
+    gene_index_dct = dict((gene, i) for i, gene in enumerate(gene_lst))
+    row_lst, col_lst, corr_lst = [], [], []
+    for drug_i, drug in enumerate(drug_lst):
+        gene_corr_dct = drug_corr_genes_dct[drug]
+        for gene in gene_corr_dct:
+            row_lst += [drug_i]
+            col_lst += [gene_index_dct[gene]]
+            corr_lst += [gene_corr_dct[gene]]
+    return sparse.csr_matrix((corr_lst, (row_lst, col_lst)), shape=(len(
+        drug_lst), len(gene_lst)))
+
+def compute_drug_path_score_matrix(drug_gene_corr_matrix, path_unit_matrix,
+    gene_unit_matrix):
     '''
-    Given a list of nodes (either expression genes or pathways), output a
-    matrix where each row is a node's embedding vector.
+    Returns a D x P matrix of NetPath scores. Entry (i, j) is the sum, over
+    drug i's highly correlated genes, of the cosine between pathway j and the
+    gene, multiplied by the gene's correlation to the drug.
     '''
-    embedding_matrix = []
-    for node in node_list:
-        embedding_matrix += [node_embedding_dct[node]]
-    return np.matrix(embedding_matrix)
+    # Cosine matrix between pathways and genes.
+    cosine_matrix = path_unit_matrix.dot(gene_unit_matrix.T)
+    if args.cos_abs:
+        return abs(drug_gene_corr_matrix).dot(np.abs(cosine_matrix).T)
+    return drug_gene_corr_matrix.dot(cosine_matrix.T)
 
-def compute_drug_path_score(drug, gene_p_val_dct, node_embedding_dct,
-    path_to_gene_dct):
+def write_ranking_files(score_matrix, results_folder, out_fname):
     '''
-    Given a dictionary where keys are genes and values are p-values of the
-    correlation between the key and the input drug, we return a dictionary.
-    Key: (drug, pathway) pair -> (str, str)
-    Value: NetPath score, the sum of the cosine between each path and each gene
-        of the highly correlated gene set, multiplied by that gene's p-value for
-        the input drug -> float
+    Writes the drug-pathway pairs by decreasing score to the top pathway file,
+    and by increasing score to its inverse ranking file, where the score of
+    the pair ranked i-th is i over the number of pairs. Both files come from
+    one sort of the in-memory score matrix, and are written in the same pass.
     '''
-    drug_path_score_dct = {}
-
-    # Get embedding matrices for pathways and genes.
-    nci_pathways = path_to_gene_dct.keys()
-    expr_genes = gene_p_val_dct.keys()
-    path_emb_matrix = create_embedding_matrix(nci_pathways, node_embedding_dct)
-    gene_emb_matrix = create_embedding_matrix(expr_genes, node_embedding_dct)
-
-    # Compute the cosine matrix between pathways and genes.
-    cosine_matrix = (path_emb_matrix * gene_emb_matrix.T) / linalg.norm(
-        path_emb_matrix, axis=1)[:, np.newaxis] / linalg.norm(gene_emb_matrix,
-        axis=1)
-
-    for path_i, pathway in enumerate(nci_pathways):
-        # Initialize the score.
-        drug_path_score = 0.0
-        for gene_i, gene in enumerate(expr_genes):
-            # Correlation between gene and drug response.
-            gene_drug_corr = gene_p_val_dct[gene]
-            cos = cosine_matrix[path_i, gene_i]
-            if args.cos_abs:
-                drug_path_score += abs(cos * gene_drug_corr)
-            else:
-                drug_path_score += cos * gene_drug_corr
-        drug_path_score_dct[(drug, pathway)] = drug_path_score
-    return drug_path_score_dct
-
-def write_top_pathway_file(drug_path_score_dct, results_folder, out_fname):
-    out = open(results_folder + out_fname, 'w')
+    num_paths, num_pairs = len(nci_pathways), score_matrix.size
+    sorted_indices = np.argsort(-score_matrix, axis=None, kind='mergesort')
+    sorted_drugs, sorted_paths = np.divmod(sorted_indices, num_paths)
+    sorted_scores = score_matrix.ravel()[sorted_indices]
+    inverse_ranks = np.arange(1, num_pairs + 1) / float(num_pairs)
+    drug_arr = np.array(drug_lst, dtype=object)
+    drug_name_arr = np.array(drug_name_lst, dtype=object)
+    path_arr = np.array(nci_pathways, dtype=object)
+
+    out = tsv_writer.TsvWriter(results_folder + out_fname)
+    inverse_out = tsv_writer.TsvWriter('%sinverse_rankings/inverse_%s' % (
+        results_folder, out_fname))
     # Description of method.
     out.write('cosine * gene_drug_corr, unnormalized')
     out.write('\ndrug\tpath\tscore\n')
-    for (drug, pathway), score in drug_path_score_dct:
-        out.write('%s\t%s\t%f\n' % (drug, pathway, score))
+    inverse_out.write('drug\tpath\tinverse_rank\n')
+    for start in range(0, num_pairs, tsv_writer.CHUNK_SIZE):
+        top_chunk = np.arange(start, min(start + tsv_writer.CHUNK_SIZE,
+            num_pairs))
+        out.write_columns('%s\t%s\t%f\n', [drug_arr[sorted_drugs[top_chunk]],
+            path_arr[sorted_paths[top_chunk]], sorted_scores[top_chunk]])
+        # The inverse ranking file lists the same pairs from the bottom up.
+        inverse_chunk = num_pairs - 1 - top_chunk
+        inverse_out.write_columns('%s\t%s\t%g\n', [drug_name_arr[sorted_drugs[
+            inverse_chunk]], path_arr[sorted_paths[inverse_chunk]],
+            inverse_ranks[inverse_chunk]])
+    # Files are renamed when complete, so that a failed or interrupted run
+    # never leaves a partial result file.
     out.close()
+    inverse_out.close()
 
-# Writes out to file the top drug-pathway pairs with score equal to the inverse
-# of their overall ranking. 
-def write_inverse_rankings(results_folder, filename):   
-    brd_drug_to_name_dct = file_operations.get_brd_drug_to_name_dct()
-
-    drug_path_dct = {}
-    f = open(results_folder + filename, 'r')
-    for i, line in enumerate(f):
-        # Skip header lines.
-        if i < 2:
-            continue
-        line = line.strip().split('\t')
-        assert len(line) == 3
-        drug, path, score = line
-        drug_path_dct[(drug, path)] = float(score)
-    f.close()
-
-    # Sort ppi dictionary by value.
-    ranked_drug_path_dct = {}
-    drug_path_dct = sorted(drug_path_dct.items(), key=operator.itemgetter(1),
-        reverse=True)
-    for i, ((drug, path), score) in enumerate(drug_path_dct):
-        inverse_ranking = (i + 1) / float(len(drug_path_dct))
-        ranked_drug_path_dct[(drug, path)] = inverse_ranking
-
-    ranked_drug_path_dct = sorted(ranked_drug_path_dct.items(),
-        key=operator.itemgetter(1), reverse=True)
-
-    inverse_folder = '%sinverse_rankings/' % results_folder
-    if not os.path.exists(inverse_folder):
-        os.makedirs(inverse_folder)
-
-    out = open(inverse_folder + 'inverse_' + filename, 'w')
-    out.write('drug\tpath\tinverse_rank\n')
-    for (drug, path), score in ranked_drug_path_dct:
-        out.write('%s\t%s\t%g\n' % (brd_drug_to_name_dct[drug], path, score))
-    out.close()
+def score_embedding_file(emb_fname):
+    '''
+    Computes and writes the top pathway file and its inverse ranking file for
+    one embedding file, using the shared inputs loaded by
+    compute_drug_pathway_scores. Runs in a pool worker, so errors are returned
+    instead of raised.
+    Returns a (str, str) pair: the embedding filename, and the error traceback,
+    or None if the file succeeded.
+    '''
+    try:
+        # Get the embedding vectors for each node (gene or pathway).
+        emb_mat, node_index_dct = file_operations.get_embedding_store(
+            emb_fname, emb_node_lst)
+        path_unit_matrix = get_unit_vector_matrix(emb_mat, node_index_dct,
+            nci_pathways)
+        gene_unit_matrix = get_unit_vector_matrix(emb_mat, node_index_dct,
+            gene_lst)
+
+        # Calculate the score for each drug-pathway pair.
+        score_matrix = compute_drug_path_score_matrix(drug_gene_corr_matrix,
+            path_unit_matrix, gene_unit_matrix)
+
+        # input_suffix = '%s_%g' % (args.sort_value, args.pearson_thresh)
+        # if args.cos_abs:
+        #     input_suffix += '_cosAbs'
+        # else:
+        #     input_suffix += '_cosNoAbs'
+        # if isPpi:
+        #     out_fname = 'top_pathways_ppi_%s_%s_%s_embed_%d_%s.txt' % (
+        #         dimension, fraction, suffix, top_k, input_suffix)
+        # else:
+        #     out_fname = 'top_pathways_%s_%s_%s_embed_%d_%s.txt' % (
+        #         dimension, fraction, suffix, top_k, input_suffix)
+        out_fname = '%s_top_pathways_%s_%s_%g_%d_%s' % (os.path.basename(
+            emb_fname), args.input_file, args.sort_value, args.pearson_thresh,
+            args.top_k, args.cos_abs)
+        # Sort the scores, and write to file.
+        write_ranking_files(score_matrix, results_folder, out_fname)
+    except Exception:
+        return emb_fname, traceback.format_exc()
+    return emb_fname, None
 
 def compute_drug_pathway_scores():
+    '''
+    Loads the inputs shared by every embedding file once, then scores the
+    embedding files in ./data/embedding_new across num_workers processes.
+    Returns the embedding files that failed -> list(str)
+    '''
+    global emb_node_lst, nci_pathways, drug_lst, drug_name_lst, gene_lst
+    global drug_gene_corr_matrix, results_folder
     # Extract the NCI pathway data.
     path_to_gene_dct, nci_genes = file_operations.get_path_to_gene_dct()
     # Find genes and pathways that appear in embedding.
@@ -152,6 +155,17 @@ def compute_drug_pathway_scores():
         args.input_file, args.top_k, emb_node_lst, args.sort_value,
         args.pearson_thresh)
 
+    # The drug-gene correlations are shared by all embedding files.
+    nci_pathways = list(path_to_gene_dct)
+    drug_lst = list(drug_corr_genes_dct)
+    # Names of the drugs for the inverse ranking files.
+    brd_drug_to_name_dct = file_operations.get_brd_drug_to_name_dct()
+    drug_name_lst = [brd_drug_to_name_dct[drug] for drug in drug_lst]
+    gene_lst = sorted(set([gene for drug in drug_lst for gene in
+        drug_corr_genes_dct[drug]]))
+    drug_gene_corr_matrix = get_drug_gene_corr_matrix(drug_lst, gene_lst,
+        drug_corr_genes_dct)
+
     # dimension_list = map(str, [50, 100, 500, 1000])
     # fraction_list, suffix_list = map(str, [0.3, 0.5, 0.8]), ['U', 'US']
     # if isPpi:
@@ -160,51 +174,42 @@ def compute_drug_pathway_scores():
     # for dimension in dimension_list:
     #     for fraction in fraction_list:
     #         for suffix in suffix_list:
+    emb_fname_lst = []
     for subdir, dirs, files in os.walk('./data/embedding_new'):
         for fname in files:
-            # Get the embedding vectors for each node (gene or pathway).
-            # node_embedding_dct = get_embedding_dct(dimension, suffix,
-            #     fraction, emb_node_lst, all_genes, path_to_gene_dct)
             if 'no_drug' in fname:
                 continue
-            new_fname = '%s/%s' % (subdir, fname)
-            node_embedding_dct = get_embedding_dct(new_fname, emb_node_lst,
-                all_genes, path_to_gene_dct)
-
-            # Calculate the score for each drug-pathway pair.
-            drug_path_score_dct = {}
-            for drug in drug_corr_genes_dct:
-                gene_p_val_dct = drug_corr_genes_dct[drug]
-                drug_path_score_dct.update(compute_drug_path_score(drug,
-                    gene_p_val_dct, node_embedding_dct, path_to_gene_dct))
-
-            # Sort the score dictionary, and write to file.
-            drug_path_score_dct = sorted(drug_path_score_dct.items(),
-                key=operator.itemgetter(1), reverse=True)
-            
-            # results_folder = './results/embedding/'
-            results_folder = './results/embedding_new/'
-            if not os.path.exists(results_folder):
-                os.makedirs(results_folder)
-
-            # input_suffix = '%s_%g' % (args.sort_value, args.pearson_thresh)
-            # if args.cos_abs:
-            #     input_suffix += '_cosAbs'
-            # else:
-            #     input_suffix += '_cosNoAbs'
-            # if isPpi:
-            #     out_fname = 'top_pathways_ppi_%s_%s_%s_embed_%d_%s.txt' % (
-            #         dimension, fraction, suffix, top_k, input_suffix)
-            # else:
-            #     out_fname = 'top_pathways_%s_%s_%s_embed_%d_%s.txt' % (
-            #         dimension, fraction, suffix, top_k, input_suffix)
-            out_fname = '%s_top_pathways_%s_%s_%g_%d_%s' % (fname,
-                args.input_file, args.sort_value, args.pearson_thresh,
-                args.top_k, args.cos_abs)
-            write_top_pathway_file(drug_path_score_dct, results_folder,
-                out_fname)
-
-            write_inverse_rankings(results_folder, out_fname)
+            emb_fname_lst += ['%s/%s' % (subdir, fname)]
+
+    # Create the output folders before the workers start writing.
+    # results_folder = './results/embedding/'
+    results_folder = './results/embedding_new/'
+    if not os.path.exists(results_folder + 'inverse_rankings/'):
+        os.makedirs(results_folder + 'inverse_rankings/')
+
+    # Workers are forked after the shared inputs are loaded, so they share
+    # them instead of reading them again.
+    if args.num_workers > 1:
+        pool = Pool(processes=args.num_workers)
+        results = pool.imap_unordered(score_embedding_file, emb_fname_lst)
+    else:
+        results = (score_embedding_file(fname) for fname in emb_fname_lst)
+
+    failed_fname_lst = []
+    for emb_fname, error in results:
+        if error == None:
+            print('Finished %s' % emb_fname)
+        else:
+            print('Failed %s\n%s' % (emb_fname, error))
+            failed_fname_lst += [emb_fname]
+    if args.num_workers > 1:
+        pool.close()
+        pool.join()
+
+    if failed_fname_lst != []:
+        print('%d of %d embedding files failed:\n%s' % (len(failed_fname_lst),
+            len(emb_fname_lst), '\n'.join(failed_fname_lst)))
+    return failed_fname_lst
 
 def parse_args():
     global args
@@ -219,6 +224,8 @@ def parse_args():
         required=True, type=int)
     parser.add_argument('-c', '--cos_abs', required=True, type=bool,
         help='Whether or not to use the absolute value of the cosine similarity.')
+    parser.add_argument('-w', '--num_workers', type=int, default=1,
+        help='Number of embedding files to score in parallel.')
     args = parser.parse_args()
 
 def main():
@@ -235,7 +242,10 @@ def main():
     # pearson_thresh = float(sys.argv[3])
     # cos_abs = sys.argv[4] == 'cos_abs'
     
-    compute_drug_pathway_scores()
+    failed_fname_lst = compute_drug_pathway_scores()
+    # Exit non-zero so that batch runs notice missing ranking files.
+    if failed_fname_lst != []:
+        sys.exit(1)
 
 if __name__ == '__main__':
     start_time = time.time()
@@ -46,18 +46,17 @@ def get_entity_vector(network, dimension, suffix, embedding_gene_pathway_lst,
     else:
         filename = '%s%s.network_net_%s' % (subfolder, network, extension)
 
-    f = open(filename, 'r')
-    for i, line in enumerate(f):
-        # Each row in the file maps to the row in gene_pathway_id.txt.
+    emb_mat, node_index_dct = file_operations.get_embedding_store(filename,
+        embedding_gene_pathway_lst)
+    for i in range(emb_mat.shape[0]):
+        # Each row in the matrix maps to the row in gene_pathway_id.txt.
         entity = embedding_gene_pathway_lst[i]
         # Skip genes and pathways that don't appear in expression genes.
         if (entity not in embedding_and_expression_genes) and (entity
             not in nci_path_dct):
             continue
-        # Convert lines to floats.
         assert entity not in entity_vector_dct
-        entity_vector_dct[entity] = map(float, line.split())
-    f.close()
+        entity_vector_dct[entity] = emb_mat[i]
     return entity_vector_dct, extension
 
 def create_pathway_vector_matrix(nci_pathways, entity_vector_dct):
@@ -162,7 +161,7 @@ def find_top_pathways(network, top_k):
     nci_path_dct, nci_genes = file_operations.get_nci_path_dct()
     # Find genes and pathways that appear in embedding.
     embedding_gene_pathway_lst = (
-        file_operations.get_embedding_gene_pathway_lst())
+        file_operations.get_emb_node_lst())
     # Find the most significantly correlated genes for each drug.
     (embedding_and_expression_genes, drug_top_genes_dct
         ) = file_operations.get_corr_drug_top_genes(top_k,
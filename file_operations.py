@@ -3,9 +3,18 @@
 from collections import OrderedDict
 import math
 import numpy as np
+import os
 import pandas as pd
-import random
+import re
+from scipy import sparse
 from scipy.special import betainc
+from scipy.stats import chi2
+import tempfile
+
+# Number of genes correlated at a time by get_pairwise_pearson_batches.
+PEARSON_BATCH_SIZE = 1000
+# Folder for the binary caches of parsed data files.
+CACHE_FOLDER = './data/cache'
 
 ### This file contains functions that parse the data files and return the 
 ### data objects that we work with in our scripts.
@@ -23,24 +32,68 @@ def get_lincs_genes():
     f.close()
     return lincs_genes
 
+def read_lincs_z_score_matrix(fname, dtype):
+    '''
+    Parses a LINCS level 4 file, where each line is a drug/cell-line followed
+    by its raw z-score for every column of all_map.txt.
+    Returns a (list, list, matrix) tuple.
+    list_0: drug/cell-line of each row, with repeats for replicates -> list(str)
+    list_1: LINCS genes, the columns of the matrix -> list(str)
+    matrix: absolute z-scores, with '#NAME?' as -inf -> np.array
+    Columns of undefined genes ('-666') are dropped, and genes appearing in
+    several columns keep the max value, in order of first appearance.
+    '''
+    lincs_df = pd.read_csv(fname, sep=r'\s+', header=None, index_col=0,
+        na_values=['#NAME?'], keep_default_na=False,
+        float_precision='round_trip')
+    drugs = [str(drug) for drug in lincs_df.index]
+    z_score_matrix = np.abs(lincs_df.values.astype(dtype))
+    del lincs_df
+    z_score_matrix[np.isnan(z_score_matrix)] = -np.inf
+
+    # Map each column to its gene's index, or -1 for undefined genes.
+    raw_lincs_genes = get_lincs_genes()
+    assert len(raw_lincs_genes) == z_score_matrix.shape[1]
+    lincs_genes, gene_index_dct, col_gene_indices = [], {}, []
+    for gene in raw_lincs_genes:
+        if gene == '-666':
+            col_gene_indices += [-1]
+            continue
+        if gene not in gene_index_dct:
+            gene_index_dct[gene] = len(lincs_genes)
+            lincs_genes += [gene]
+        col_gene_indices += [gene_index_dct[gene]]
+    col_gene_indices = np.array(col_gene_indices)
+
+    # Group each gene's columns together, then take each group's max.
+    cols = np.nonzero(col_gene_indices >= 0)[0]
+    cols = cols[np.argsort(col_gene_indices[cols], kind='mergesort')]
+    group_starts = np.searchsorted(col_gene_indices[cols], np.arange(len(
+        lincs_genes)))
+    z_score_matrix = np.maximum.reduceat(z_score_matrix[:, cols],
+        group_starts, axis=1)
+    return drugs, lincs_genes, z_score_matrix
+
 # lincs_top_pathways.py
-def get_drugs_and_gene_matrix():
+# preprocess_lincs_z_scores.py
+def get_lincs_z_score_matrix(fname, dtype=np.float32):
     '''
-    Reads the LINCS data, and returns a (list, list) tuple.
-    list_0: list of drug names -> list(str)
-    list_1: 2D list of pre-normalization z-scores -> list(list(str))
-    Each row of list_1 corresponds to a gene in list_0.
+    Returns the same (list, list, matrix) tuple as read_lincs_z_score_matrix.
+    The result is cached in binary form, so later calls memory-map it instead
+    of parsing the LINCS file, until the LINCS file or all_map.txt changes.
     '''
-    f = open('./data/new_lvl4_Stuart_combinedPvalue_diff_normalize_DMSO.txt',
-        'r')
-    drugs, gene_matrix = [], []
-    for line in f:
-        line = line.split()
-        drug, raw_z_scores = line[0], line[1:]
-        drugs += [drug]
-        gene_matrix += [raw_z_scores]
-    f.close()
-    return drugs, gene_matrix
+    cache_prefix = get_cache_prefix(fname, tag='.%s' % np.dtype(dtype).name,
+        dependency_fnames=['./data/all_map.txt'])
+    z_score_matrix, label_dct = load_matrix_cache(cache_prefix)
+    if z_score_matrix is not None:
+        return (label_dct['drugs'].tolist(), label_dct['lincs_genes'].tolist(),
+            z_score_matrix)
+
+    drugs, lincs_genes, z_score_matrix = read_lincs_z_score_matrix(fname,
+        dtype)
+    write_matrix_cache(cache_prefix, z_score_matrix, drugs=np.array(drugs),
+        lincs_genes=np.array(lincs_genes))
+    return drugs, lincs_genes, z_score_matrix
 
 # lincs_top_pathways.py
 # drug_pathway_fisher_correlation.py
@@ -70,13 +123,118 @@ def get_path_to_gene_dct():
 
     return path_to_gene_dct, nci_gene_set
 
-# drug_pathway_fisher_correlation.py
-def get_dr_df():
-    dr_df = pd.read_csv('./data/auc_hgnc.tsv', sep='\t', header=0, index_col=0,
+def get_cache_prefix(fname, tag='', dependency_fnames=[]):
+    '''
+    Returns the path prefix of the binary cache files for a data file. The
+    prefix ends with the sizes and modification times of the data file and of
+    the other files the cache depends on, so editing any of them automatically
+    points readers to a new, empty cache. tag tells apart different caches of
+    the same data file.
+    '''
+    cache_key = os.path.normpath(fname).replace(os.sep, '__') + tag
+    version_lst = []
+    for version_fname in [fname] + dependency_fnames:
+        stat = os.stat(version_fname)
+        version_lst += ['%d_%d' % (stat.st_size, int(stat.st_mtime * 1e6))]
+    return '%s/%s.%s' % (CACHE_FOLDER, cache_key, '_'.join(version_lst))
+
+def load_matrix_cache(cache_prefix):
+    '''
+    Returns a (matrix, dictionary) pair written by write_matrix_cache, or
+    (None, None) if there is no cache yet.
+    matrix: memory-mapped, read-only matrix -> np.memmap
+    dictionary: label arrays saved with the matrix -> {str: np.array}
+    '''
+    mat_fname = '%s.npy' % cache_prefix
+    label_fname = '%s.labels.npz' % cache_prefix
+    if not (os.path.exists(mat_fname) and os.path.exists(label_fname)):
+        return None, None
+    label_npz = np.load(label_fname)
+    label_dct = dict((key, label_npz[key]) for key in label_npz.files)
+    label_npz.close()
+    return np.load(mat_fname, mmap_mode='r'), label_dct
+
+def write_matrix_cache(cache_prefix, matrix, **label_dct):
+    '''
+    Saves a matrix and its label arrays under cache_prefix, and deletes the
+    caches of older versions of the same data file. Files are written under
+    temporary names and then renamed, so readers never see partial caches.
+    '''
+    if not os.path.exists(CACHE_FOLDER):
+        os.makedirs(CACHE_FOLDER)
+    # Delete stale caches of the same key and tag, which only differ from
+    # cache_prefix in their versions. Other tags of the same data file match
+    # a different key, so they are kept.
+    cache_key, version = os.path.basename(cache_prefix).rsplit('.', 1)
+    stale_pattern = re.compile(r'%s\.\d+_\d+(_\d+_\d+)*\.(npy|labels\.npz)$' %
+        re.escape(cache_key))
+    for old_fname in os.listdir(CACHE_FOLDER):
+        if (stale_pattern.match(old_fname) and not old_fname.startswith(
+            '%s.%s.' % (cache_key, version))):
+            os.remove(os.path.join(CACHE_FOLDER, old_fname))
+
+    mat_fname = '%s.npy' % cache_prefix
+    label_fname = '%s.labels.npz' % cache_prefix
+    # Each writer has its own temporary files, so concurrent runs that build
+    # the same cache never write into each other's files.
+    mat_fd, mat_tmp_fname = tempfile.mkstemp(suffix='.tmp', dir=CACHE_FOLDER)
+    f = os.fdopen(mat_fd, 'wb')
+    np.save(f, np.ascontiguousarray(matrix))
+    f.close()
+    label_fd, label_tmp_fname = tempfile.mkstemp(suffix='.tmp',
+        dir=CACHE_FOLDER)
+    f = os.fdopen(label_fd, 'wb')
+    np.savez(f, **label_dct)
+    f.close()
+    # The label file goes last, since load_matrix_cache checks for both.
+    os.rename(mat_tmp_fname, mat_fname)
+    os.rename(label_tmp_fname, label_fname)
+
+def get_cached_df(fname, read_df):
+    '''
+    Returns read_df(fname), a numeric data frame. The first call writes the
+    values and labels to a binary cache, and later calls memory-map the cache
+    instead of parsing fname again, until fname changes.
+    '''
+    cache_prefix = get_cache_prefix(fname)
+    matrix, label_dct = load_matrix_cache(cache_prefix)
+    if matrix is not None:
+        df = pd.DataFrame(matrix, index=label_dct['index'].tolist(),
+            columns=label_dct['columns'].tolist())
+        df.index.name = label_dct['index_name'].tolist()[0] or None
+        return df
+
+    df = read_df(fname)
+    write_matrix_cache(cache_prefix, df.values, index=np.array(
+        df.index.tolist()), columns=np.array(df.columns.tolist()),
+        index_name=np.array([df.index.name or '']))
+    return df
+
+def read_dr_df(fname):
+    dr_df = pd.read_csv(fname, sep='\t', header=0, index_col=0,
         na_values='NA')
     dr_df = dr_df.apply(pd.to_numeric)
     return dr_df
 
+# lincs_top_pathways.py
+def get_gene_set_matrix(gene_set_lst, gene_index_dct):
+    '''
+    Returns a sparse binary matrix with one row per gene set in gene_set_lst,
+    and one column per gene in gene_index_dct. Entry (i, j) is 1 if the j-th
+    gene is in the i-th gene set.
+    '''
+    row_lst, col_lst = [], []
+    for set_i, gene_set in enumerate(gene_set_lst):
+        for gene in gene_set:
+            row_lst += [set_i]
+            col_lst += [gene_index_dct[gene]]
+    return sparse.csr_matrix((np.ones(len(row_lst), dtype=int), (row_lst,
+        col_lst)), shape=(len(gene_set_lst), len(gene_index_dct)))
+
+# drug_pathway_fisher_correlation.py
+def get_dr_df():
+    return get_cached_df('./data/auc_hgnc.tsv', read_dr_df)
+
 # # drug_pathway_fisher_correlation.py
 # # correlation_top_pathways_kw.py
 # def get_drug_to_dr_dct():
@@ -124,15 +282,50 @@ def get_dr_df():
 #     # print gene_expr_df.loc[['TTL']]
 #     return gene_expr_df
 
-# drug_pathway_fisher_correlation.py
-def get_gene_df(fname):
-    gene_df = pd.read_csv('./data/%s' % fname, sep='\t', header=0, index_col=0,
+def read_gene_df(fname):
+    gene_df = pd.read_csv(fname, sep='\t', header=0, index_col=0,
         na_values='NA')
 
     gene_df = gene_df.apply(pd.to_numeric)
     gene_df = gene_df[~gene_df.index.duplicated(keep='last')]
     return gene_df
 
+# drug_pathway_fisher_correlation.py
+def get_gene_df(fname):
+    return get_cached_df('./data/%s' % fname, read_gene_df)
+
+# correlation_top_pathways_kw.py
+def get_gene_expression_dct():
+    '''
+    Returns a dictionary mapping genes to gene expression values, in the order
+    of the gene expression file. Duplicate genes keep their last row.
+    Key: gene -> str
+    Value: read-only row of gene expression values -> np.array
+    '''
+    gene_df = get_gene_df('gene_expression_hgnc.tsv')
+    gene_expr_mat = np.asarray(gene_df.values)
+    gene_expr_mat.flags.writeable = False
+    return OrderedDict(zip(gene_df.index, gene_expr_mat))
+
+# correlation_top_pathways_kw.py
+def get_drug_response_dct():
+    '''
+    Returns a dictionary mapping drugs to drug response values. Drugs that are
+    unavailable for all patients are skipped.
+    Key: drug -> str
+    Value: list of drug responses, None where the response is 'NA'
+        -> list(float)
+    '''
+    drug_response_dct = OrderedDict({})
+    dr_df = get_dr_df()
+    for drug, resp_line in zip(dr_df.index, dr_df.values):
+        is_na = np.isnan(resp_line)
+        if is_na.all():
+            continue
+        drug_response_dct[drug] = [None if na else val for na, val in zip(
+            is_na.tolist(), resp_line.tolist())]
+    return drug_response_dct
+
 # # drug_pathway_fisher_correlation.py
 # # correlation_top_pathways_kw.py
 # def get_gene_expr_mat():
@@ -296,6 +489,59 @@ def get_emb_node_lst():
     f.close()
     return emb_node_lst
 
+def read_embedding_matrix(fname):
+    '''
+    Parses a whitespace-separated embedding text file into a matrix, one row
+    per line.
+    '''
+    return pd.read_csv(fname, sep=r'\s+', header=None, dtype=np.float64,
+        float_precision='round_trip').values
+
+# embedding_top_pathways.py
+# embedding_top_pathways_just_cosine.py
+# random_embedding_top_pathways.py
+# impute_drugless_embeddings.py
+def get_embedding_store(fname, emb_node_lst):
+    '''
+    Returns a (matrix, dictionary) pair for an embedding file. The text file
+    is only parsed the first time. Later calls memory-map its binary cache.
+    matrix: row i is the embedding vector of the i-th node in
+        gene_pathway_id.txt -> np.memmap
+    dictionary: index of each node's row in the matrix -> {str: int}
+    '''
+    cache_prefix = get_cache_prefix(fname)
+    emb_mat, label_dct = load_matrix_cache(cache_prefix)
+    if emb_mat is None:
+        write_matrix_cache(cache_prefix, read_embedding_matrix(fname))
+        emb_mat, label_dct = load_matrix_cache(cache_prefix)
+    # Files without pathway embeddings only have the first rows.
+    node_index_dct = dict((node, i) for i, node in enumerate(
+        emb_node_lst[:emb_mat.shape[0]]))
+    return emb_mat, node_index_dct
+
+def get_node_vectors(emb_mat, node_index_dct, node_lst):
+    '''
+    Returns the matrix of embedding vectors for the nodes in node_lst, in the
+    same order.
+    '''
+    return emb_mat[[node_index_dct[node] for node in node_lst]]
+
+# embedding_top_pathways.py
+def get_pearson_file_index(fname):
+    '''
+    Reads the .idx file written next to a drug-gene Pearson file by
+    drug_pathway_fisher_correlation.py.
+    Returns a list of (drug, byte offset, number of lines) triples, one per
+    drug block -> list((str, int, int))
+    '''
+    pearson_file_index = []
+    f = open('%s.idx' % fname, 'r')
+    for line in f:
+        drug, offset, num_lines = line.split()
+        pearson_file_index += [(drug, int(offset), int(num_lines))]
+    f.close()
+    return pearson_file_index
+
 # embedding_top_pathways.py
 def get_drug_corr_genes_dct(input_file, top_k, emb_node_lst, sort_value,
     pearson_thresh):
@@ -305,48 +551,79 @@ def get_drug_corr_genes_dct(input_file, top_k, emb_node_lst, sort_value,
     Value: a nested dictionary -> {}
         Key: gene -> str
         Value: Pearson correlation coefficient -> float
-    Also returns set of genes that appear in both embedding and expression data.
+    Also returns the set of embedding genes that are among the top_k genes of
+    at least one drug.
+    If the Pearson file is grouped by drug, only reads each drug's block up to
+    its top_k embedding genes.
     '''
     all_genes = set([])
     drug_corr_genes_dct = {}
+    emb_node_set = set(emb_node_lst)
+
+    fname = './results/%s_gene_drug_pearson_%s_%g.txt' % (input_file,
+        sort_value, pearson_thresh)
+    f = open(fname, 'r')
+    if os.path.exists('%s.idx' % fname):
+        # Each drug's genes are contiguous and already in ranked order.
+        is_index_valid = True
+        for index_drug, offset, num_lines in get_pearson_file_index(fname):
+            corr_genes_dct = {}
+            f.seek(offset)
+            for i in range(num_lines):
+                line = f.readline().split()
+                # Lines of another drug mean the index does not match the
+                # file, which is then scanned in full below.
+                if len(line) < 3 or line[1] != index_drug:
+                    is_index_valid = False
+                    break
+                gene, drug, correlation = line[:3]
+                if gene not in emb_node_set:
+                    continue
+                all_genes.add(gene)
+                corr_genes_dct[gene] = float(correlation)
+                # Stop reading the drug's block at top_k genes.
+                if len(corr_genes_dct) == top_k:
+                    break
+            if not is_index_valid:
+                break
+            if corr_genes_dct != {}:
+                drug_corr_genes_dct[index_drug] = corr_genes_dct
+        if is_index_valid:
+            f.close()
+            return all_genes, drug_corr_genes_dct
+        all_genes, drug_corr_genes_dct = set([]), {}
+        f.seek(0)
 
-    f = open('./results/%s_gene_drug_pearson_%s_%g.txt' % (input_file,
-        sort_value, pearson_thresh), 'r')
     for i, line in enumerate(f):
         if i == 0: # Skip header.
             continue
         # TODO: there is p-value info right now.
         gene, drug, correlation, p_val = line.split()
         # gene, drug, correlation = line.split()
-        if gene not in emb_node_lst:
+        if gene not in emb_node_set:
             continue
-        # The gene appears in both expression and embedding.
-        all_genes.add(gene)
         # Initialize the dictionary.
         if drug not in drug_corr_genes_dct:
             drug_corr_genes_dct[drug] = {}
         # Stop adding genes when we've reached top_k genes for the drug.
         if len(drug_corr_genes_dct[drug]) == top_k:
             continue
+        # The gene appears in both expression and embedding, and is one of
+        # the drug's top_k genes.
+        all_genes.add(gene)
         drug_corr_genes_dct[drug][gene] = float(correlation)
     f.close()
 
     return all_genes, drug_corr_genes_dct
 
-def get_corr_drug_random_genes(top_k, emb_node_lst):
+# random_embedding_top_pathways.py
+def get_random_gene_candidates(emb_node_lst):
     '''
-    Returns a dictionary where each key is a drug, and each value is another
-    dictionary d_2, where each key is a gene, and each value is a p-value
-    corresponding to the correlation between the drug and the gene. We pick
-    top_k random genes for each drug.
+    Returns the sorted list of genes that appear in both the embedding and the
+    gene expression data, from which the random control draws its gene sets.
     '''
-    gene_expr_mat = get_gene_expr_mat()
-    embedding_and_expression_genes = list(set(emb_node_lst
-        ).intersection(gene_expr_mat.keys()))
-
-    random.shuffle(embedding_and_expression_genes)
-
-    return embedding_and_expression_genes[:top_k]
+    expression_genes = get_gene_df('gene_expression_hgnc.tsv').index
+    return sorted(set(emb_node_lst).intersection(expression_genes))
 
 # drug_pathway_fisher_correlation.py
 # correlation_top_pathways_kw.py
@@ -380,4 +657,167 @@ def compute_p_val(r, n):
         t_squared = r**2 * (df / ((1.0 - r) * (1.0 + r)))
         # prob = betai(0.5*df, 0.5, df/(df+t_squared))
         prob = betainc(0.5*df, 0.5, df/(df+t_squared))
-    return prob
\ No newline at end of file
+    return prob
+
+# drug_pathway_fisher_correlation.py
+def compute_p_vals(r, n):
+    '''
+    Vectorized compute_p_val. Given an array of Pearson correlation
+    coefficients and the sample sizes they were computed on (an array that
+    broadcasts against r), returns the array of p-values. NaN coefficients
+    give NaN p-values.
+    '''
+    # Same clipping as scipy.stats.pearsonr for rounding errors.
+    r = np.clip(r, -1.0, 1.0)
+    df = np.asarray(n, dtype=float) - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_squared = r**2 * (df / ((1.0 - r) * (1.0 + r)))
+        prob = betainc(0.5*df, 0.5, df/(df+t_squared))
+    # Perfect correlations have infinite t-statistics.
+    prob[np.abs(r) == 1.0] = 0.0
+    return prob
+
+# drug_pathway_fisher_correlation.py
+def get_pearson_matrices(dr_mat, gene_mat):
+    '''
+    Correlates every drug with every gene in one pass, where dr_mat is a
+    D x S matrix of drug responses that may contain NaN, and gene_mat is a
+    G x S matrix with no missing values. Each drug only uses its non-NaN
+    samples, handled with masked sums instead of dropping samples per pair.
+    Returns a (matrix, matrix) pair.
+    matrix_0: D x G Pearson correlation coefficients -> np.array
+    matrix_1: D x 1 number of samples used by each drug -> np.array
+    '''
+    valid = ~np.isnan(dr_mat)
+    num_samples = valid.sum(axis=1)[:, np.newaxis].astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Centre both sides so the sums of squares don't lose precision.
+        dr_mat = np.where(valid, dr_mat, 0.0)
+        dr_mat = np.where(valid, dr_mat - dr_mat.sum(axis=1)[:, np.newaxis] /
+            num_samples, 0.0)
+        gene_mat = gene_mat - gene_mat.mean(axis=1)[:, np.newaxis]
+        valid = valid.astype(float)
+
+        # Sums of the genes restricted to each drug's valid samples.
+        gene_sum = valid.dot(gene_mat.T)
+        gene_sq_sum = valid.dot((gene_mat**2).T)
+        dr_sum = dr_mat.sum(axis=1)[:, np.newaxis]
+        dr_sq_sum = (dr_mat**2).sum(axis=1)[:, np.newaxis]
+
+        cov = dr_mat.dot(gene_mat.T) - dr_sum * gene_sum / num_samples
+        dr_var = dr_sq_sum - dr_sum**2 / num_samples
+        gene_var = gene_sq_sum - gene_sum**2 / num_samples
+        r = cov / np.sqrt(dr_var * gene_var)
+    return r, num_samples
+
+# drug_pathway_fisher_correlation.py
+def get_pairwise_pearson_batches(dr_mat, gene_mat,
+    batch_size=PEARSON_BATCH_SIZE):
+    '''
+    Pairwise-complete version of get_pearson_matrices for the gene
+    essentiality screens, where both dr_mat (D x S) and gene_mat (G x S) may
+    contain NaN. Each drug-gene pair only uses the samples valid in both,
+    computed from products of the indicator-masked matrices. Genes are
+    processed batch_size at a time to bound memory.
+    Yields (int, matrix, matrix) triples.
+    int: index of the batch's first gene in gene_mat -> int
+    matrix_0: D x B Pearson correlation coefficients -> np.array
+    matrix_1: D x B number of samples used by each drug-gene pair -> np.array
+    '''
+    dr_valid = ~np.isnan(dr_mat)
+    dr_ind = dr_valid.astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Centre each drug by a constant so the sums of squares don't lose
+        # precision. Correlations are unaffected by the shift.
+        dr_mat = np.where(dr_valid, dr_mat, 0.0)
+        dr_mat = np.where(dr_valid, dr_mat - dr_mat.sum(axis=1)[:,
+            np.newaxis] / dr_ind.sum(axis=1)[:, np.newaxis], 0.0)
+    dr_sq_mat = dr_mat**2
+
+    for start in range(0, gene_mat.shape[0], batch_size):
+        batch = gene_mat[start:start + batch_size]
+        gene_valid = ~np.isnan(batch)
+        gene_ind = gene_valid.astype(float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            batch = np.where(gene_valid, batch, 0.0)
+            batch = np.where(gene_valid, batch - batch.sum(axis=1)[:,
+                np.newaxis] / gene_ind.sum(axis=1)[:, np.newaxis], 0.0)
+
+            # Effective sample size of every drug-gene pair.
+            num_samples = dr_ind.dot(gene_ind.T)
+            # Sums over the samples valid for both the drug and the gene.
+            dr_sum = dr_mat.dot(gene_ind.T)
+            dr_sq_sum = dr_sq_mat.dot(gene_ind.T)
+            gene_sum = dr_ind.dot(batch.T)
+            gene_sq_sum = dr_ind.dot((batch**2).T)
+
+            cov = dr_mat.dot(batch.T) - dr_sum * gene_sum / num_samples
+            dr_var = dr_sq_sum - dr_sum**2 / num_samples
+            gene_var = gene_sq_sum - gene_sum**2 / num_samples
+            r = cov / np.sqrt(dr_var * gene_var)
+        yield start, r, num_samples
+
+# lincs_top_pathways_kw.py
+def get_rank_matrix(value_matrix):
+    '''
+    Ranks each row of a 2D array, giving tied values their average rank like
+    scipy.stats.rankdata. Non-finite values are left out, as in scipy's mstats
+    tests, and get rank 0. Returns a (matrix, np.array) tuple.
+    matrix: ranks from 1 to the number of finite values in the row -> np.array
+    np.array: sum of t^3 - t over the tie groups of each row, where t is the
+        size of the group, for the Kruskal-Wallis tie correction -> np.array
+    '''
+    value_matrix = np.asarray(value_matrix, dtype=float)
+    num_rows, num_cols = value_matrix.shape
+    row_indices = np.arange(num_rows)[:, np.newaxis]
+    # Non-finite values are sorted to the end of their rows.
+    is_valid = np.isfinite(value_matrix)
+    order = np.argsort(np.where(is_valid, value_matrix, np.inf), axis=1,
+        kind='mergesort')
+    sorted_values = value_matrix[row_indices, order]
+
+    # A tie group starts at the first value of each row and at each change.
+    is_group_start = np.ones(value_matrix.shape, dtype=bool)
+    is_group_start[:, 1:] = sorted_values[:, 1:] != sorted_values[:, :-1]
+    is_group_start = is_group_start.ravel()
+    group_ids = np.cumsum(is_group_start) - 1
+    group_starts = np.nonzero(is_group_start)[0]
+    group_sizes = np.bincount(group_ids).astype(float)
+
+    # Average of the ranks start + 1, ..., start + size of each group.
+    group_ranks = group_starts % num_cols + (group_sizes + 1) / 2.0
+    rank_matrix = np.empty(value_matrix.shape)
+    rank_matrix[row_indices, order] = group_ranks[group_ids].reshape(
+        value_matrix.shape)
+    rank_matrix[~is_valid] = 0.0
+
+    is_valid_group = is_valid[row_indices, order].ravel()[group_starts]
+    tie_sums = np.bincount(group_starts // num_cols, weights=np.where(
+        is_valid_group, group_sizes**3 - group_sizes, 0.0), minlength=num_rows)
+    return rank_matrix, tie_sums
+
+# lincs_top_pathways_kw.py
+def compute_kruskal_wallis(rank_sums, group_sizes, num_values, tie_sums):
+    '''
+    Vectorized two-group Kruskal-Wallis test, the same as
+    scipy.stats.mstats.kruskalwallis(group, rest). Each test is given by the
+    rank sum and size of its group, the total number of ranked values and the
+    tie sum from get_rank_matrix. The second group is everything else, so its
+    rank sum and size follow from the first. Arguments broadcast against each
+    other. Empty groups add nothing to the statistic.
+    Returns a (np.array, np.array) tuple of H statistics and p-values.
+    '''
+    rank_sums = np.asarray(rank_sums, dtype=float)
+    group_sizes = np.asarray(group_sizes, dtype=float)
+    num_values = np.asarray(num_values, dtype=float)
+    rest_rank_sums = num_values * (num_values + 1) / 2.0 - rank_sums
+    rest_sizes = num_values - group_sizes
+    with np.errstate(divide='ignore', invalid='ignore'):
+        group_terms = (np.where(group_sizes > 0, rank_sums**2 / group_sizes,
+            0.0) + np.where(rest_sizes > 0, rest_rank_sums**2 / rest_sizes,
+            0.0))
+        h_stats = (12.0 / (num_values * (num_values + 1)) * group_terms - 3 * (
+            num_values + 1))
+        # Tie correction.
+        h_stats = h_stats / (1.0 - tie_sums / (num_values**3 - num_values))
+    return h_stats, chi2.sf(h_stats, 1)
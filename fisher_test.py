@@ -0,0 +1,117 @@
+### Author: Edward Huang
+
+from collections import OrderedDict
+import numpy as np
+from scipy.stats import hypergeom
+
+### Fisher's exact test p-values from cached hypergeometric tail tables. The
+### distribution of a 2x2 table's top-left cell only depends on the universe
+### size, the table's row margin and its column margin. Our enrichment tests
+### reuse a small set of margins (pathway sizes, max_genes_per_drug), so each
+### table of log tail probabilities is computed once and looked up afterwards.
+
+# Maximum number of (universe, row margin, column margin) tables kept.
+MAX_CACHED_TABLES = 4096
+
+# Least recently used tables are at the front.
+tail_table_cache = OrderedDict({})
+
+def get_tail_tables(universe, row_margin, col_margin):
+    '''
+    Returns the log-probability tables of the top-left cell count k of a 2x2
+    table with the given margins, indexed by k = 0...min(row, col).
+    Returns a (np.array, np.array, np.array) triple.
+    array_0: log P(X = k)
+    array_1: log P(X >= k), the right tail
+    array_2: log P(X <= k), the left tail
+    '''
+    key = (int(universe), int(row_margin), int(col_margin))
+    if key in tail_table_cache:
+        # Move the table to the most recently used end.
+        tail_tables = tail_table_cache.pop(key)
+        tail_table_cache[key] = tail_tables
+        return tail_tables
+
+    k = np.arange(min(row_margin, col_margin) + 1)
+    min_k = max(0, row_margin + col_margin - universe)
+    if universe == 0 or min_k == k[-1]:
+        # Only one table has these margins, so every p-value is 1, as in
+        # scipy's fisher_exact. hypergeom.logpmf is NaN for an empty universe.
+        log_pmf = np.where(k == min_k, 0.0, -np.inf)
+        log_right_tail = np.where(k <= min_k, 0.0, -np.inf)
+        log_left_tail = np.where(k >= min_k, 0.0, -np.inf)
+    else:
+        log_pmf = hypergeom.logpmf(k, universe, row_margin, col_margin)
+        log_right_tail = np.logaddexp.accumulate(log_pmf[::-1])[::-1]
+        log_left_tail = np.logaddexp.accumulate(log_pmf)
+    tail_tables = (log_pmf, log_right_tail, log_left_tail)
+
+    tail_table_cache[key] = tail_tables
+    if len(tail_table_cache) > MAX_CACHED_TABLES:
+        tail_table_cache.popitem(last=False)
+    return tail_tables
+
+def right_tail_p_values(inter, row_margin, col_margin, universe):
+    '''
+    Vectorized one-sided Fisher's test, the same as scipy's
+    fisher_exact(alternative='greater'), for arrays of tables given by their
+    top-left cell counts and margins. Arguments broadcast against each other.
+    Each distinct (universe, row margin, column margin) triple only costs one
+    table lookup.
+    '''
+    inter, row_margin, col_margin, universe = np.broadcast_arrays(
+        np.asarray(inter, dtype=int), np.asarray(row_margin, dtype=int),
+        np.asarray(col_margin, dtype=int), np.asarray(universe, dtype=int))
+    margin_matrix = np.column_stack((universe.ravel(), row_margin.ravel(),
+        col_margin.ravel()))
+    if margin_matrix.shape[0] == 0:
+        return np.zeros(inter.shape)
+    unique_margins, inverse = np.unique(margin_matrix, axis=0,
+        return_inverse=True)
+    inverse = inverse.ravel()
+
+    # Group the tables by margins, and look each group up in one table.
+    flat_inter = inter.ravel()
+    p_values = np.empty(len(flat_inter))
+    order = np.argsort(inverse, kind='mergesort')
+    group_ends = np.cumsum(np.bincount(inverse, minlength=len(
+        unique_margins)))
+    group_start = 0
+    for margin_i, group_end in enumerate(group_ends):
+        group = order[group_start:group_end]
+        group_start = group_end
+        log_right_tail = get_tail_tables(*unique_margins[margin_i])[1]
+        p_values[group] = np.exp(log_right_tail[flat_inter[group]])
+    return np.minimum(p_values, 1.0).reshape(inter.shape)
+
+class FishersExactTest(object):
+    '''
+    Fisher's exact test on a 2x2 table [[a, b], [c, d]], backed by the cached
+    tail tables.
+    '''
+    def __init__(self, f_table):
+        (a, b), (c, d) = f_table
+        self.inter = a
+        self.log_pmf, self.log_right_tail, self.log_left_tail = (
+            get_tail_tables(a + b + c + d, a + b, a + c))
+
+    def right_tail_p(self):
+        '''
+        P-value of the top-left cell being at least as large as observed.
+        '''
+        return min(np.exp(self.log_right_tail[self.inter]), 1.0)
+
+    def left_tail_p(self):
+        '''
+        P-value of the top-left cell being at most as large as observed.
+        '''
+        return min(np.exp(self.log_left_tail[self.inter]), 1.0)
+
+    def two_tail_p(self):
+        '''
+        Sum of the probabilities of all tables at most as likely as the
+        observed one, with the same relative tolerance as scipy.
+        '''
+        log_pmf = self.log_pmf
+        as_extreme = log_pmf <= log_pmf[self.inter] + np.log1p(1e-7)
+        return min(np.exp(log_pmf[as_extreme]).sum(), 1.0)
@@ -3,6 +3,7 @@
 import file_operations
 import numpy as np
 import os
+import pathway_index
 
 ### This script takes the embedding files that do not contain pathway embeddings,
 ### and adds pathway embeddings by averaging, for each pathway, its member genes'
@@ -15,32 +16,28 @@ def read_embedding_file(fname, emb_node_lst):
     Value: embedding vector -> list(float)
     '''
     node_embedding_dct = {}
-    f = open(fname, 'r')
-    for i, line in enumerate(f):
-        # Each row in the file maps to the row in gene_pathway_id.txt.
-        node = emb_node_lst[i]
+    emb_mat, node_index_dct = file_operations.get_embedding_store(fname,
+        emb_node_lst)
+    for node in node_index_dct:
         assert ' ' not in node # Pathways have spaces.
-        node_embedding_dct[node] = map(float, line.split())
-    f.close()
+        node_embedding_dct[node] = emb_mat[node_index_dct[node]].tolist()
     assert len(node_embedding_dct) == 18362
     return node_embedding_dct
 
-def get_pathway_embeddings(node_embedding_dct, path_to_gene_dct):
+def get_pathway_embeddings(node_embedding_dct, path_index):
     '''
     Get the pathways' embeddings by averaging their member genes' embedding
-    vectors.
+    vectors. All pathways are averaged at once, by multiplying the pathway
+    membership matrix over the embedded genes with their vectors.
     '''
-    pathway_embedding_dct = {}
-    for pathway in path_to_gene_dct:
-        gene_set = path_to_gene_dct[pathway]
-        # Get the embedding vectors for the gene set.
-        embedding_vector_lst = []
-        for gene in gene_set:
-            if gene in node_embedding_dct:
-                embedding_vector_lst += [node_embedding_dct[gene]]
-        # Average the vectors for the gene set.
-        pathway_embedding_dct[pathway] = np.mean(embedding_vector_lst, axis=0)
-    return pathway_embedding_dct
+    gene_lst = list(node_embedding_dct)
+    embedding_mat = np.array([node_embedding_dct[gene] for gene in gene_lst])
+    path_matrix = path_index.get_membership_matrix(gene_lst)
+    num_genes = np.asarray(path_matrix.sum(axis=1), dtype=float)
+    # Sum the vectors for each gene set, then average them.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        path_embedding_mat = path_matrix.dot(embedding_mat) / num_genes
+    return dict(zip(path_index.path_lst, path_embedding_mat))
 
 def write_embedding_file(fname, pathway_embedding_dct, node_embedding_dct, emb_node_lst):
     '''
@@ -60,7 +57,7 @@ def write_embedding_file(fname, pathway_embedding_dct, node_embedding_dct, emb_n
 
 def main():
     emb_node_lst = file_operations.get_emb_node_lst()
-    path_to_gene_dct, nci_gene_set = file_operations.get_path_to_gene_dct()
+    path_index = pathway_index.get_pathway_index()
 
     for subdir, dirs, files in os.walk('./data/embedding_new'):
         for fname in files:
@@ -71,7 +68,7 @@ def main():
             node_embedding_dct = read_embedding_file(fname, emb_node_lst)
             
             pathway_embedding_dct = get_pathway_embeddings(node_embedding_dct,
-                path_to_gene_dct)
+                path_index)
 
             write_embedding_file(fname, pathway_embedding_dct,
                 node_embedding_dct, emb_node_lst)
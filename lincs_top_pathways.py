@@ -2,183 +2,207 @@
 
 from collections import OrderedDict
 import file_operations
+import fisher_test
+from multiprocessing import Pool
 import numpy as np
 import operator
-from scipy.stats import fisher_exact
+import pathway_index
+from scipy import sparse
 import sys
 import time
+import tsv_writer
 
 ### Gets the top pathways for each drug/cell-line using the LINCS data set.
-### Usage: python top_pathways_lincs.py
+### Drugs/cell-lines can be split into shards across num_workers processes.
+### Usage: python lincs_top_pathways.py z_score_min max_genes_per_drug
+###     num_workers<optional>
 ### Run time: 50 minutes
 
 # This variable doesn't affect the code. It is just helps count low p-values
 # for eyeballing purposes.
 LOW_P_THRESHOLD = 0.0001 # Count how many pathway-drug pairs are below this.
+# Number of drugs/cell-lines scored at a time, by one worker.
+DRUG_SHARD_SIZE = 500
 
-def get_gene_to_z_dct(gene_matrix, drugs, lincs_genes):
+def get_drug_mean_z_matrix(drugs, z_score_matrix):
     '''
-    Returns a dictionary.
-    Key: gene -> str
-    Value: list of z-scores -> list(float)
+    Averages the z-scores of different experiments of the same drug-cell line
+    pair. Each drug row is the product of a sparse indicator row and the LINCS
+    matrix, so the replicates are never copied out of the matrix.
+    Returns a (list, np.array) tuple.
+    list: drug/cell-line keys, in order of first appearance -> list(str)
+    np.array: 2D array of mean z-scores, one row per drug -> np.array
     '''
-    gene_to_z_dct, gene_counter = OrderedDict({}), 0
-
-    while gene_matrix != []:
-        gene_z_scores = gene_matrix.pop(0)
-        assert len(gene_z_scores) == len(drugs)
-        gene = lincs_genes[gene_counter]
-
-        gene_counter += 1
-        # Skip undefined genes.
-        if gene == '-666':
-            continue
-
-        # Take the absolute value of the z-scores.
-        neg_inf = float('-inf')
-        gene_z_scores = [neg_inf if score == '#NAME?' else abs(float(score)
-            ) for score in gene_z_scores]
-        if gene not in gene_to_z_dct:
-            gene_to_z_dct[gene] = gene_z_scores
-        else:
-            # If a gene appears twice, then we want to get the max values.
-            for ci, value in enumerate(gene_z_scores):
-                gene_to_z_dct[gene][ci] = max(gene_to_z_dct[gene][ci], value)
-    return gene_to_z_dct
-
-def get_drug_to_z_dct(drugs, gene_to_z_dct):
+    drug_index_dct = OrderedDict({})
+    row_drug_indices = np.array([drug_index_dct.setdefault(drug, len(
+        drug_index_dct)) for drug in drugs], dtype=int)
+    num_experiments = np.bincount(row_drug_indices)
+
+    # Sum each drug's experiments, then divide by the number of experiments.
+    drug_row_matrix = sparse.csr_matrix((np.ones(len(drugs)), (
+        row_drug_indices, np.arange(len(drugs)))), shape=(len(drug_index_dct),
+        len(drugs)))
+    mean_z_matrix = drug_row_matrix.dot(z_score_matrix)
+    mean_z_matrix /= num_experiments[:, None]
+    return list(drug_index_dct), mean_z_matrix
+
+def get_drug_to_top_genes_dct(drug_lst, mean_z_matrix, lincs_genes):
     '''
-    Returns a dictionary mapping drugs to their LINCS z-scores.
-    Key: drug -> str
-    Value: list of LINCS z-scores -> list(float)
-    '''
-    # Transposing back the z-scores.
-    drug_to_z_dct = [drugs]
-    for gene in gene_to_z_dct:
-        drug_to_z_dct += [gene_to_z_dct[gene]]
-    gene_to_z_dct.clear()
-    drug_to_z_dct = zip(*drug_to_z_dct)
-
-    # Make a new dictionary and reconstruct the drug to z-score mappings.
-    temp_drug_to_z_dct = OrderedDict({})
-    for row in drug_to_z_dct:
-        drug, z_scores = row[0], row[1:]
-
-        assert type(z_scores[0]) == float
-
-        if drug in temp_drug_to_z_dct:
-            temp_drug_to_z_dct[drug] += [z_scores]
-        else:
-            temp_drug_to_z_dct[drug] = [z_scores]
-    return temp_drug_to_z_dct
-
-def get_drug_to_top_genes_dct(drug_to_z_dct, lincs_genes):
-    '''
-    Takes the drug to z-score dictionary and returns a new dictionary. The
-    higher the z-score, the more correlated the drug and the gene are.
+    Takes the mean z-score matrix and returns a dictionary. The higher the
+    z-score, the more correlated the drug and the gene are.
     Key: drug -> str
     Value: list of genes with the highest z-scores, maximum max_genes_per_drug
                 -> list(str)
     '''
-    drug_top_genes_dct = {}
-    for drug in drug_to_z_dct:
-        z_scores = drug_to_z_dct[drug]
-        # Average the z-scores for different experiments of the same drug-cell
-        # line pair.
-        z_scores = [np.mean(x) for x in zip(*z_scores)]
-
-        top_gene_indices = []
-        for i, z_score in enumerate(z_scores):
-            if z_score >= z_score_min:
-                top_gene_indices += [(i, z_score)]
-        # Take only at most max_genes_per_drug.
-        top_gene_indices = sorted(top_gene_indices, key=lambda k:k[1],
-            reverse=True)[:max_genes_per_drug]
-        # Update the drug with the top genes from LINCS.
-        drug_top_genes_dct[drug] = [lincs_genes[i] for (i,
-            z_score) in top_gene_indices]
+    num_drugs, num_genes = mean_z_matrix.shape
+    num_top = min(max_genes_per_drug, num_genes)
+    if num_top <= 0:
+        return dict((drug, []) for drug in drug_lst)
+
+    # The last num_top columns of each row hold its highest z-scores.
+    top_indices = np.argpartition(mean_z_matrix, num_genes - num_top,
+        axis=1)[:, num_genes - num_top:]
+    kth_z_scores = mean_z_matrix[np.arange(num_drugs)[:, None],
+        top_indices].min(axis=1)[:, None]
+    is_top = mean_z_matrix > kth_z_scores
+
+    # Break ties at the cutoff by gene index, as the stable sort did.
+    is_tie = mean_z_matrix == kth_z_scores
+    num_ties_kept = num_top - is_top.sum(axis=1)
+    for drug_i in np.nonzero(is_tie.sum(axis=1) > num_ties_kept)[0]:
+        tie_indices = np.nonzero(is_tie[drug_i])[0]
+        is_tie[drug_i, tie_indices[num_ties_kept[drug_i]:]] = False
+    is_top |= is_tie
+    is_top &= mean_z_matrix >= z_score_min
+
+    # Update each drug with its top genes from LINCS.
+    lincs_genes = np.array(lincs_genes)
+    drug_indices, gene_indices = np.nonzero(is_top)
+    row_ends = np.cumsum(np.bincount(drug_indices, minlength=num_drugs))
+    drug_top_genes_dct, row_start = {}, 0
+    for drug, row_end in zip(drug_lst, row_ends):
+        drug_top_genes_dct[drug] = lincs_genes[gene_indices[row_start:row_end]
+            ].tolist()
+        row_start = row_end
     return drug_top_genes_dct
 
-def compute_top_pathways_per_drug(lincs_genes, drug_top_genes_dct):
+def compute_top_pathways_per_drug(drug_lst, drug_top_genes_dct):
     '''
     Calculates the Fisher's exact test for every drug's top genes and every
-    NCI pathway's genes. Returns the sorted results and the number of drug-path
-    pairs that exceed LOW_P_THRESHOLD.
+    NCI pathway's genes. Drugs and pathways are rows of sparse binary matrices
+    over the LINCS genes, so every intersection size comes from one sparse
+    matrix product, and the one-sided p-values are looked up for whole arrays
+    in fisher_test's cached hypergeometric tails. Pathway sizes count all of
+    the pathway's genes.
+    Returns a (dictionary, int) tuple.
+    dictionary: drugs x pathways arrays of the p-values ('p_value') and the
+        Fisher's table counts ('inter', 'corr_not_path', 'path_not_corr'), in
+        the order of drug_lst and path_index.path_lst -> {str: np.array}
+    int: number of drug-path pairs below LOW_P_THRESHOLD -> int
+    '''
+    # Genes with the top z-scores for each drug, up to max_genes_per_drug.
+    drug_matrix = file_operations.get_gene_set_matrix([drug_top_genes_dct[
+        drug] for drug in drug_lst], lincs_gene_index_dct)
+
+    # Get the four relevant numbers for Fisher's test for every pair.
+    corr_and_path = drug_matrix.dot(lincs_path_matrix.T).toarray()
+    corr_len = np.asarray(drug_matrix.sum(axis=1))
+    path_len = path_index.path_sizes[np.newaxis]
+    corr_not_path = corr_len - corr_and_path
+    path_not_corr = path_len - corr_and_path
+
+    # One-sided Fisher's test, same as fisher_exact(alternative='greater').
+    p_values = fisher_test.right_tail_p_values(corr_and_path, corr_len,
+        path_len, universe_size)
+    num_low_p = int((p_values < LOW_P_THRESHOLD).sum())
+
+    fisher_table_dct = {'p_value':p_values, 'inter':corr_and_path,
+        'corr_not_path':corr_not_path, 'path_not_corr':path_not_corr}
+    return fisher_table_dct, num_low_p
+
+def score_drug_shard(shard):
     '''
-    # Read NCI pathway dictionary and the lincs_genes in the NCI pathways.
-    nci_path_dct, nci_genes = file_operations.get_nci_path_dct()
-
-    # Fisher's test for every drug/cell-line and path pair.
-    gene_universe = len(nci_genes.union(lincs_genes))
-    fisher_p_val_dct, num_low_p = {}, 0
-    for drug in drug_top_genes_dct:
-        # Genes with the top z-scores for each drug, up to max_genes_per_drug.
-        corr_genes = set(drug_top_genes_dct[drug])
-        for path in nci_path_dct:
-            path_genes = set(nci_path_dct[path])
-
-            # Get the four relevant numbers for Fisher's test.
-            corr_and_path = len(corr_genes.intersection(path_genes))
-            corr_not_path = len(corr_genes.difference(path_genes))
-            path_not_corr = len(path_genes.difference(corr_genes))
-            neither = gene_universe - len(corr_genes.union(path_genes))
-            # Compute Fisher's test.
-            f_table = ([[corr_and_path, corr_not_path], [path_not_corr,
-                neither]])
-            o_r, p_value = fisher_exact(f_table, alternative='greater')
-            if p_value < LOW_P_THRESHOLD:
-                num_low_p += 1
-            fkey = (drug, path, corr_and_path, corr_not_path, path_not_corr)
-            fisher_p_val_dct[fkey] = p_value
-    sorted_fisher = sorted(fisher_p_val_dct.items(), key=operator.itemgetter(1))
-
-    return sorted_fisher, num_low_p
-
-def write_top_pathways(sorted_fisher, num_low_p):
+    Picks the top genes and computes the Fisher's tests of the drugs in
+    drug_lst[start:end]. Uses the globals set by main, which forked workers
+    share. Returns the same tuple as compute_top_pathways_per_drug.
+    '''
+    start, end = shard
+    drug_top_genes_dct = get_drug_to_top_genes_dct(drug_lst[start:end],
+        mean_z_matrix[start:end], lincs_genes)
+    return compute_top_pathways_per_drug(drug_lst[start:end],
+        drug_top_genes_dct)
+
+def write_top_pathways(drug_lst, path_lst, fisher_table_dct, num_low_p):
     # Write how many drug-pathway pairs have a very low p-value, determined by
     # LOW_P_THRESHOLD.
     subfolder = './results/lincs_top_pathway_files'
-    out = open('%s/top_pathways_lincs_z%g_max%d.txt' % (subfolder, z_score_min,
-        max_genes_per_drug), 'w')
+    out = tsv_writer.TsvWriter('%s/top_pathways_lincs_z%g_max%d.txt' % (
+        subfolder, z_score_min, max_genes_per_drug))
     out.write('num_p_below_%s\t%d\n' % (str(LOW_P_THRESHOLD), num_low_p))
-    # Write the drug's top pathways to file.
+    # Write the drug's top pathways to file, sorted by p-value.
     out.write('drug\tcell_line\tpath\tp-value\tinter\tlincs_len\tpath_len\n')
-    for fkey, p_val in sorted_fisher:
-        drug, path, inter, corr_len, path_len = fkey
-        drug, cell_line = drug.split('_')
-        out.write('%s\t%s\t%s\t%g\t%d\t%d\t%d\n' % (drug, cell_line, path,
-            p_val, inter, corr_len, path_len))
+    p_values = fisher_table_dct['p_value']
+    inter = fisher_table_dct['inter']
+    corr_len = fisher_table_dct['corr_not_path']
+    path_len = fisher_table_dct['path_not_corr']
+    sorted_indices = np.argsort(p_values, axis=None, kind='mergesort')
+    drug_indices, path_indices = np.divmod(sorted_indices, len(path_lst))
+    drug_arr, cell_line_arr = np.array([drug.split('_') for drug in drug_lst],
+        dtype=object).reshape(-1, 2).T
+    out.write_columns('%s\t%s\t%s\t%g\t%d\t%d\t%d\n', [drug_arr[
+        drug_indices], cell_line_arr[drug_indices], np.array(path_lst,
+        dtype=object)[path_indices], p_values.ravel()[sorted_indices],
+        inter.ravel()[sorted_indices], corr_len.ravel()[sorted_indices],
+        path_len.ravel()[sorted_indices]])
     out.close()
 
 def main():
     if (len(sys.argv) < 3):
-        print "Usage: " + sys.argv[0] + " z_score_min max_genes_per_drug"
+        print ("Usage: " + sys.argv[0] + " z_score_min max_genes_per_drug "
+            "num_workers<optional>")
         exit(1)
 
     global z_score_min, max_genes_per_drug
     z_score_min, max_genes_per_drug = float(sys.argv[1]), int(sys.argv[2])
-
-    lincs_genes = file_operations.get_lincs_genes()
-    drugs, gene_matrix = file_operations.get_drugs_and_gene_matrix()
-
-    # Transpose the gene matrix so we can filter out the lincs_genes.
-    gene_matrix = zip(*gene_matrix)
-    assert len(gene_matrix) == len(lincs_genes)
-    
-    gene_to_z_dct = get_gene_to_z_dct(gene_matrix, drugs, lincs_genes)
-
-    # Update lincs_genes to be just the valid ones in our dictionary. We lose
-    # some genes because some are labeled as '-666'
-    lincs_genes = gene_to_z_dct.keys()
-
-    drug_to_z_dct = get_drug_to_z_dct(drugs, gene_to_z_dct)
-
-    drug_top_genes_dct = get_drug_to_top_genes_dct(drug_to_z_dct, lincs_genes)
-
-    sorted_fisher, num_low_p = compute_top_pathways_per_drug(lincs_genes,
-        drug_top_genes_dct)
-
-    write_top_pathways(sorted_fisher, num_low_p)
+    num_workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+
+    global drug_lst, mean_z_matrix, lincs_genes, lincs_gene_index_dct
+    global path_index, lincs_path_matrix, universe_size
+    # Absolute z-scores, with '-666' genes dropped and duplicate genes merged.
+    drugs, lincs_genes, z_score_matrix = (
+        file_operations.get_lincs_z_score_matrix(
+        './data/new_lvl4_Stuart_combinedPvalue_diff_normalize_DMSO.txt'))
+
+    drug_lst, mean_z_matrix = get_drug_mean_z_matrix(drugs, z_score_matrix)
+    lincs_gene_index_dct = dict((gene, i) for i, gene in enumerate(
+        lincs_genes))
+    # The gene universe is every NCI pathway gene and every LINCS gene.
+    path_index = pathway_index.get_pathway_index()
+    lincs_path_matrix = path_index.get_membership_matrix(lincs_genes)
+    universe_size = len(path_index.gene_lst) + int((
+        path_index.get_gene_ids(lincs_genes) == -1).sum())
+
+    # Workers are forked after the shared inputs are built, so they share
+    # them. Shards come back in drug order whatever worker scored them.
+    shard_lst = [(start, min(start + DRUG_SHARD_SIZE, len(drug_lst))) for
+        start in range(0, len(drug_lst), DRUG_SHARD_SIZE)]
+    if num_workers > 1:
+        pool = Pool(processes=num_workers)
+        results = pool.map(score_drug_shard, shard_lst)
+        pool.close()
+        pool.join()
+    else:
+        results = [score_drug_shard(shard) for shard in shard_lst]
+
+    fisher_table_dct = {}
+    for key in ['p_value', 'inter', 'corr_not_path', 'path_not_corr']:
+        fisher_table_dct[key] = np.vstack([shard_fisher_table_dct[key] for
+            shard_fisher_table_dct, shard_num_low_p in results])
+    num_low_p = sum([shard_num_low_p for shard_fisher_table_dct,
+        shard_num_low_p in results])
+
+    write_top_pathways(drug_lst, path_index.path_lst, fisher_table_dct,
+        num_low_p)
 
 if __name__ == '__main__':
     start_time = time.time()
@@ -1,77 +1,220 @@
 ### Author: Edward Huang
 
-from collections import OrderedDict
+import argparse
 import file_operations
-import operator
-from scipy.stats.mstats import kruskalwallis
+import heapq
+import itertools
+from multiprocessing import Pool
+import numpy as np
+import pathway_index
+import shutil
+import tempfile
 import time
+import tsv_writer
 
 ### Gets the top pathways for each drug/cell-line using the LINCS data set.
-### Usage: python top_pathways_lincs.py
+### Each signature's z-scores are ranked once, and the Kruskal-Wallis test of
+### every pathway's genes against the other LINCS genes only needs the rank
+### sum of the pathway's genes, which comes from one sparse matrix product.
+### Signatures are scored in chunks, and each chunk's pairs are sorted and
+### spilled to a run file, so memory depends on the chunk size rather than on
+### the number of signatures. The runs are merged into the sorted output.
+### Chunks can be scored by a pool of num_workers processes.
+### Usage: python lincs_top_pathways_kw.py [-c chunk_size] [-w num_workers]
 ### Run time: 42 minutes
 
 KRUSKAL_P_THRESH = 0.05
+LINCS_FNAME = './data/processed_lincs_normalized_DMSO.txt'
+# Record of a drug-pathway pair in a sorted run file.
+RUN_DTYPE = np.dtype([('p_value', np.float64), ('pair_i', np.int64),
+    ('h_stat', np.float64)])
+# Number of records read from a run file at a time while merging.
+RUN_READ_SIZE = 65536
 
-def main():
-    # Read NCI pathway dictionary and the lincs_genes in the NCI pathways.
-    nci_path_dct, nci_genes = file_operations.get_nci_path_dct()
+def get_path_membership_matrix(lincs_genes):
+    '''
+    Returns a (list, matrix, np.array) tuple.
+    list: NCI pathways, the rows of the matrix -> list(str)
+    matrix: sparse binary matrix, entry (i, j) is 1 if the j-th LINCS gene is
+        in the i-th pathway -> scipy.sparse.csr_matrix
+    np.array: number of LINCS genes in each pathway -> np.array
+    '''
+    path_index = pathway_index.get_pathway_index()
+    path_matrix = path_index.get_membership_matrix(lincs_genes)
+    path_sizes = np.diff(path_matrix.indptr)
+    return path_index.path_lst, path_matrix, path_sizes
+
+def compute_signature_kw(z_score_matrix, path_matrix, path_sizes):
+    '''
+    Computes the Kruskal-Wallis test between the z-scores of each pathway's
+    genes and the rest of the genes, for every signature (row) of
+    z_score_matrix and every pathway at once. path_sizes are the pathway sizes
+    from get_path_membership_matrix.
+    Returns a (matrix, matrix) tuple of signatures x pathways H statistics and
+    p-values.
+    '''
+    rank_matrix, tie_sums = file_operations.get_rank_matrix(z_score_matrix)
+    # Rank sum of each pathway's genes, signatures x pathways.
+    rank_sums = path_matrix.dot(rank_matrix.T).T
+    # Undefined z-scores are left out of both groups.
+    is_valid = np.isfinite(z_score_matrix)
+    if is_valid.all():
+        num_valid, path_sizes = z_score_matrix.shape[1], path_sizes
+    else:
+        num_valid = is_valid.sum(axis=1)[:, np.newaxis]
+        path_sizes = path_matrix.dot(is_valid.T.astype(float)).T
+    return file_operations.compute_kruskal_wallis(rank_sums, path_sizes,
+        num_valid, tie_sums[:, np.newaxis])
+
+def get_signature_chunks(f, chunk_size):
+    '''
+    Scans the signature lines of the preprocessed LINCS file, after its header
+    line has been read. Yields an (int, int) tuple for every chunk_size lines.
+    int_0: index of the chunk -> int
+    int_1: offset of the chunk's first line in the file -> int
+    '''
+    offset = f.tell()
+    for line_i, line in enumerate(f):
+        if line_i % chunk_size == 0:
+            yield line_i // chunk_size, offset
+        offset += len(line)
+
+def write_sorted_run(run_fname, first_drug_i, p_values, h_stats):
+    '''
+    Writes a chunk's drug-pathway pairs, sorted by p-value, to a binary run
+    file. Each pair keeps its index in the signatures x pathways order of the
+    whole file, which breaks p-value ties when the runs are merged.
+    '''
+    num_paths = p_values.shape[1]
+    order = np.argsort(p_values, axis=None, kind='mergesort')
+    run = np.empty(len(order), dtype=RUN_DTYPE)
+    run['p_value'] = p_values.ravel()[order]
+    run['pair_i'] = first_drug_i * num_paths + order
+    run['h_stat'] = h_stats.ravel()[order]
+    np.save(run_fname, run)
+
+def read_sorted_run(run_fname):
+    '''
+    Yields the (bool, float, int, float) merge keys of a run file's pairs, in
+    file order. The bool marks NaN p-values, which are sorted last.
+    '''
+    run = np.load(run_fname, mmap_mode='r')
+    for start in range(0, len(run), RUN_READ_SIZE):
+        block = run[start:start + RUN_READ_SIZE]
+        p_values = block['p_value']
+        is_nan = np.isnan(p_values)
+        for key in zip(is_nan.tolist(), np.where(is_nan, 0.0, p_values
+            ).tolist(), block['pair_i'].tolist(), block['h_stat'].tolist()):
+            yield key
+
+def get_output_rows(merged_keys, drug_lst, path_lst):
+    '''
+    Yields the (drug, cell line, pathway, h-statistic, p-value) output row of
+    each merged pair key.
+    '''
+    drug_cell_line_lst = [drug.split('_') for drug in drug_lst]
+    for is_nan, p_value, pair_i, h_stat in merged_keys:
+        drug_i, path_i = divmod(pair_i, len(path_lst))
+        drug, cell_line = drug_cell_line_lst[drug_i]
+        yield (drug, cell_line, path_lst[path_i], h_stat, float('nan') if
+            is_nan else p_value)
+
+def score_signature_chunk(chunk):
+    '''
+    Reads, parses and scores one chunk of signatures, and spills its sorted
+    pairs to the chunk's run file. Uses the globals set by main, which forked
+    workers share. Returns a (list, int) tuple.
+    list: drug/cell-line of each signature in the chunk -> list(str)
+    int: number of the chunk's pairs below KRUSKAL_P_THRESH -> int
+    '''
+    chunk_i, offset = chunk
+    f = open(LINCS_FNAME, 'r')
+    f.seek(offset)
+    lines = [line.split() for line in itertools.islice(f, args.chunk_size)]
+    f.close()
+    drug_chunk = [line[0] for line in lines]
+    z_score_chunk = np.array([line[1:] for line in lines], dtype=float)
+    assert z_score_chunk.shape[1] == len(lincs_genes)
+
+    # Compute the top pathways for each drug with Kruskal-Wallis test.
+    h_stats, p_values = compute_signature_kw(z_score_chunk, path_matrix,
+        path_sizes)
+    write_sorted_run(get_run_fname(chunk_i), chunk_i * args.chunk_size,
+        p_values, h_stats)
+    return drug_chunk, int((p_values < KRUSKAL_P_THRESH).sum())
 
+def get_run_fname(chunk_i):
+    return '%s/run_%d.npy' % (run_folder, chunk_i)
+
+def parse_args():
+    global args
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--chunk_size', type=int, default=500,
+        help='Number of signatures read and scored at a time.')
+    parser.add_argument('-w', '--num_workers', type=int, default=1,
+        help='Number of signature chunks to score in parallel.')
+    args = parser.parse_args()
+
+def main():
+    parse_args()
+    global lincs_genes, path_lst, path_matrix, path_sizes, run_folder
+    num_drugs = 9298.0
     # Counts the number of drug-pathway pairs with KW p-value KRUSKAL_P_THRESH.
     num_low_p = 0
-    # Dictionary of the top drug-pathway pairs.
-    top_drug_path_pairs = {}
-    # Reading in preprocessed data.
-    lincs_genes = []
-    num_drugs = 9298.0
-    drug_counter = 0.0
-
-    f = open('./data/processed_lincs_normalized_DMSO.txt', 'r')
-    for i, line in enumerate(f):
-        line = line.split()
-        # First line is the LINCS genes.
-        if i == 0:
-            lincs_genes = line
-            continue
-        # Otherwise, read in the drug and all of its expressed genes.
-        drug, z_scores = line[0], line[1:]
-        z_scores = map(float, z_scores)
-        assert len(z_scores) == len(lincs_genes)
-
-        # Compute the top pathways for each drug with Kruskal-Wallis test.
-        for path in nci_path_dct:
-            path_genes = nci_path_dct[path]
-            # Split the into genes in the pathways and genes that aren't.
-            pathway_z_scores, non_pathway_z_scores = [], []
-            for gene_index, gene in enumerate(lincs_genes):
-                if gene in path_genes:
-                    pathway_z_scores += [z_scores[gene_index]]
-                else:
-                    non_pathway_z_scores += [z_scores[gene_index]]
-
-            h_stat, p_value = kruskalwallis(pathway_z_scores,
-                non_pathway_z_scores)
-            top_drug_path_pairs[(drug, path, h_stat)] = p_value
-
-            if p_value < KRUSKAL_P_THRESH:
-                num_low_p += 1
-        drug_counter += 1
-        print 'Progres:%f%%' % (drug_counter / num_drugs * 100)
-    f.close()
+    # Drug of each signature, in file order.
+    drug_lst = []
+    num_chunks = 0
+
+    f = open(LINCS_FNAME, 'r')
+    # First line is the LINCS genes.
+    lincs_genes = f.readline().split()
+    path_lst, path_matrix, path_sizes = get_path_membership_matrix(
+        lincs_genes)
+
+    # Each chunk's drug-pathway pairs are sorted and spilled to a run file.
+    run_folder = tempfile.mkdtemp(dir='./results')
+    pool = None
+    # The runs are deleted, and the workers stopped, even if scoring or the
+    # merge fails or is interrupted.
+    try:
+        # Workers are forked after the pathway memberships are built, so they
+        # share them. Each worker reads its own chunks, and the chunks come
+        # back in file order whatever worker scored them.
+        if args.num_workers > 1:
+            pool = Pool(processes=args.num_workers)
+            results = pool.imap(score_signature_chunk, get_signature_chunks(f,
+                args.chunk_size))
+        else:
+            results = (score_signature_chunk(chunk) for chunk in
+                get_signature_chunks(f, args.chunk_size))
 
-    top_paths = sorted(top_drug_path_pairs.items(), key=operator.itemgetter(1))
+        for drug_chunk, chunk_num_low_p in results:
+            num_low_p += chunk_num_low_p
+            drug_lst += drug_chunk
+            num_chunks += 1
+            print 'Progres:%f%%' % (len(drug_lst) / num_drugs * 100)
+        if pool is not None:
+            pool.close()
+            pool.join()
+            pool = None
 
-    # Write out the results.
-    path_out = open('./results/top_pathways_lincs_diff_normalize_DMSO_kw.txt',
-        'w')
-    path_out.write('num_below_%f\t%d\n' % (KRUSKAL_P_THRESH, num_low_p))
-    path_out.write('drug\tcell_line\tpath\th_statistic\tp_value\n')    
-    for (drug, path, h_stat), p_val in top_paths:
-        drug, cell_line = drug.split('_')
-        path_out.write('%s\t%s\t%s\t%g\t%g\n' % (drug, cell_line, path,
-            h_stat, p_val))
-    path_out.close()
+        # Write out the results, merging the sorted runs.
+        path_out = tsv_writer.TsvWriter(
+            './results/top_pathways_lincs_diff_normalize_DMSO_kw.txt')
+        path_out.write('num_below_%f\t%d\n' % (KRUSKAL_P_THRESH, num_low_p))
+        path_out.write('drug\tcell_line\tpath\th_statistic\tp_value\n')    
+        path_out.write_rows('%s\t%s\t%s\t%g\t%g\n', get_output_rows(
+            heapq.merge(*[read_sorted_run(get_run_fname(chunk_i)) for chunk_i
+            in range(num_chunks)]), drug_lst, path_lst))
+        path_out.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        f.close()
+        shutil.rmtree(run_folder)
 
 if __name__ == '__main__':
     start_time = time.time()
     main()
-    print("--- %s seconds ---" % (time.time() - start_time))
\ No newline at end of file
+    print("--- %s seconds ---" % (time.time() - start_time))
@@ -0,0 +1,121 @@
+### Author: Edward Huang
+
+import file_operations
+import numpy as np
+from scipy import sparse
+
+### Index of the NCI pathways' gene memberships. The pathways are rows and the
+### genes of all pathways are columns of a sparse binary matrix, which is built
+### once from nci_pathway_hgnc.txt and then read back from a compact binary
+### cache. Scripts query it against their own gene vocabulary (LINCS genes,
+### expression genes, embedding nodes) instead of testing Python sets.
+
+PATHWAY_FNAME = './data/nci_pathway_hgnc.txt'
+
+class PathwayIndex(object):
+    '''
+    Membership of the genes in each pathway.
+    path_lst: pathways, in order of first appearance in the file -> list(str)
+    gene_lst: union of all pathways' genes, sorted -> list(str)
+    gene_index_dct: gene -> column id -> {str: int}
+    membership_matrix: pathways x genes binary matrix -> sparse.csr_matrix
+    path_sizes: number of genes in each pathway -> np.array
+    '''
+    def __init__(self, path_lst, gene_lst, membership_matrix):
+        self.path_lst, self.gene_lst = path_lst, gene_lst
+        self.gene_index_dct = dict((gene, i) for i, gene in enumerate(
+            gene_lst))
+        self.membership_matrix = membership_matrix
+        self.path_sizes = np.diff(membership_matrix.indptr)
+
+    def get_gene_set(self):
+        '''
+        Returns the set of all genes that appear in the pathways.
+        '''
+        return set(self.gene_lst)
+
+    def get_gene_ids(self, gene_lst):
+        '''
+        Returns the column id of each gene in gene_lst, or -1 for genes in no
+        pathway -> np.array(int)
+        '''
+        return np.array([self.gene_index_dct.get(gene, -1) for gene in
+            gene_lst], dtype=int)
+
+    def get_membership_matrix(self, gene_lst):
+        '''
+        Returns the pathways x gene_lst binary matrix, where entry (i, j) is 1
+        if the j-th gene of gene_lst is in the i-th pathway -> csr_matrix
+        '''
+        gene_ids = self.get_gene_ids(gene_lst)
+        in_path = np.nonzero(gene_ids >= 0)[0]
+        # Selects each vocabulary gene's column out of the index's columns.
+        selection_matrix = sparse.csr_matrix((np.ones(len(in_path), dtype=
+            self.membership_matrix.dtype), (gene_ids[in_path], in_path)),
+            shape=(len(self.gene_lst), len(gene_lst)))
+        return self.membership_matrix.dot(selection_matrix).tocsr()
+
+    def get_membership_mask(self, path, gene_lst):
+        '''
+        Returns a boolean array, True for the genes of gene_lst that are in the
+        pathway -> np.array(bool)
+        '''
+        row = self.membership_matrix[self.path_lst.index(path)]
+        is_member = np.zeros(len(self.gene_lst) + 1, dtype=bool)
+        is_member[row.indices] = True
+        # Genes in no pathway have id -1, which points at the last False.
+        return is_member[self.get_gene_ids(gene_lst)]
+
+    def get_intersection_counts(self, gene_set_matrix, gene_lst):
+        '''
+        Given a binary matrix of gene sets x gene_lst, returns the gene sets x
+        pathways matrix of the sizes of their intersections -> np.array
+        '''
+        return np.asarray(sparse.csr_matrix(gene_set_matrix).dot(
+            self.get_membership_matrix(gene_lst).T).toarray())
+
+def read_pathway_index(fname):
+    '''
+    Parses the pathway file, where each line is a pathway and one of its
+    genes, into a PathwayIndex.
+    '''
+    path_lst, path_index_dct, path_gene_pairs = [], {}, set([])
+    f = open(fname, 'r')
+    for line in f:
+        path, gene = line.strip().split('\t')
+        if path not in path_index_dct:
+            path_index_dct[path] = len(path_lst)
+            path_lst += [path]
+        path_gene_pairs.add((path_index_dct[path], gene))
+    f.close()
+
+    gene_lst = sorted(set([gene for path_i, gene in path_gene_pairs]))
+    gene_index_dct = dict((gene, i) for i, gene in enumerate(gene_lst))
+    row_lst = [path_i for path_i, gene in path_gene_pairs]
+    col_lst = [gene_index_dct[gene] for path_i, gene in path_gene_pairs]
+    membership_matrix = sparse.csr_matrix((np.ones(len(row_lst), dtype=
+        np.int32), (row_lst, col_lst)), shape=(len(path_lst), len(gene_lst)))
+    membership_matrix.sort_indices()
+    return PathwayIndex(path_lst, gene_lst, membership_matrix)
+
+def get_pathway_index(fname=PATHWAY_FNAME):
+    '''
+    Returns the PathwayIndex of a pathway file. The first call saves the
+    index's arrays to the binary cache, and later calls read them back
+    instead of parsing the file, until the file changes.
+    '''
+    cache_prefix = file_operations.get_cache_prefix(fname, tag='.index')
+    indices, label_dct = file_operations.load_matrix_cache(cache_prefix)
+    if indices is not None:
+        membership_matrix = sparse.csr_matrix((np.ones(len(indices), dtype=
+            np.int32), np.array(indices), label_dct['indptr']), shape=(len(
+            label_dct['path_lst']), len(label_dct['gene_lst'])))
+        return PathwayIndex(label_dct['path_lst'].tolist(), label_dct[
+            'gene_lst'].tolist(), membership_matrix)
+
+    pathway_index = read_pathway_index(fname)
+    membership_matrix = pathway_index.membership_matrix
+    file_operations.write_matrix_cache(cache_prefix, membership_matrix.indices,
+        indptr=membership_matrix.indptr, path_lst=np.array(
+        pathway_index.path_lst), gene_lst=np.array(pathway_index.gene_lst))
+    return pathway_index
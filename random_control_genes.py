@@ -4,6 +4,7 @@ import file_operations
 import fisher_test
 import math
 import random
+import ranking_file
 from subtract_superdrug_from_pathways import get_superdrug_pathways
 import sys
 
@@ -12,27 +13,20 @@ import sys
 
 # For a given set of superdrug pathways, finds the number of pathways for
 # each drug-pathway pair that are better than the threshold.
-def get_exp_paths_per_drug(random_p_thresh, superdrug_pathways):
-    f = open('./results/top_pathways_exp_hgnc.txt', 'r')
+def get_exp_paths_per_drug(exp_rankings, random_p_thresh, superdrug_pathways):
     exp_paths_per_drug = {}
-    for i, line in enumerate(f):
-        # Skip header lines.
-        if i < 2:
-            continue
-        drug, path, score = line.strip().split('\t')[:3]
+    # Only the scored lines below the threshold are visited.
+    line_ids = exp_rankings.get_line_ids_below(random_p_thresh)
+    for (drug, path), score in zip(exp_rankings.get_pairs(line_ids),
+        exp_rankings.scores[line_ids].tolist()):
         # We need to skip corresponding superdrug pathways for each
         # threshold.
-        if score == '[]' or path in superdrug_pathways:
+        if path in superdrug_pathways:
             continue
-        # If a Fisher's p-value is below the threshold, add it to the
-        # dictionary.
-        score = float(score)
-        if score <= random_p_thresh:
-            if drug in exp_paths_per_drug:
-                exp_paths_per_drug[drug] += [score]
-            else:
-                exp_paths_per_drug[drug] = [score]
-    f.close()
+        if drug in exp_paths_per_drug:
+            exp_paths_per_drug[drug] += [score]
+        else:
+            exp_paths_per_drug[drug] = [score]
     return exp_paths_per_drug
 
 # Sample N pathways from the set of pathways not significant for the
@@ -58,6 +52,9 @@ if __name__ == '__main__':
     pathways = set(nci_path_dct.keys())
     # Extract LINCS data.
     lincs_drug_path_dct = file_operations.get_lincs_drug_path_dct()
+    # Expression top pathways, read once for all runs.
+    exp_rankings = ranking_file.get_ranking_file(
+        './results/top_pathways_exp_hgnc.txt')
 
     table_dct = {}
     # Run script by NUM_RUNS loops each.
@@ -67,8 +64,8 @@ if __name__ == '__main__':
             # Gets the pathways significant for the superdrug for the given
             # threshold.
             superdrug_pathways = set(get_superdrug_pathways(random_p_thresh))
-            exp_paths_per_drug = get_exp_paths_per_drug(random_p_thresh,
-                superdrug_pathways)
+            exp_paths_per_drug = get_exp_paths_per_drug(exp_rankings,
+                random_p_thresh, superdrug_pathways)
             # Get the set of pathways that are not in the superdrug pathways.
             pathways_minus_superdrug = pathways.difference(superdrug_pathways)
             sampled_drug_paths = sample_drug_paths(exp_paths_per_drug,
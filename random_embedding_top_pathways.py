@@ -1,11 +1,15 @@
 ### Author: Edward Huang
 
+import argparse
 from collections import OrderedDict
 import file_operations
 import math
+from multiprocessing import Pool
 import numpy as np
 import operator
-from scipy import spatial, linalg
+import os
+import pathway_index
+from scipy import linalg, sparse
 import sys
 import time
 
@@ -16,6 +20,11 @@ import time
 ### for a drug, taking the cosine similarity between the pathway and the
 ### gene vectors in the embedding file, multiplied by the correlation between
 ### the gene and drug response for the drug.
+### This is the random control: each pathway is scored against num_permutations
+### random gene sets. The pathway x gene cosine matrix is computed once, and
+### every random set's scores are a sum over its columns. Sets are drawn in
+### seeded blocks, which can run in parallel and are checkpointed to disk, so
+### an interrupted run can be resumed with -r.
 
 def create_dimension_list(network):
     '''
@@ -28,69 +37,53 @@ def create_dimension_list(network):
         dimension_list += [1000, 1500, 2000]
     return map(str, dimension_list)
 
-def get_entity_vector(network, dimension, suffix, embedding_gene_pathway_lst,
-    random_genes, nci_path_dct):
+def get_embedding_fname(network, dimension, suffix):
     '''
-    Returns a dictionary.
-    Each key is an entity (either a gene or a pathway).
-    Each value is the low-dimensional vector representation of the entity as
-    computed by embedding.
+    Returns the (filename, extension) pair of an embedding file.
     '''
-    entity_vector_dct = OrderedDict({})
-
-    # First, process the input network filename.
     subfolder = './data/embedding/'
     extension = '%s_0.8.%s' % (dimension, suffix)
     if network == 'ppi':
         filename = '%sppi_6_net_%s' % (subfolder, extension)
     else:
         filename = '%s%s.network_net_%s' % (subfolder, network, extension)
+    return filename, extension
 
-    f = open(filename, 'r')
-    for i, line in enumerate(f):
-        # Each row in the file maps to the row in gene_pathway_id.txt.
-        entity = embedding_gene_pathway_lst[i]
-        # Skip genes and pathways that don't appear in expression genes.
-        if (entity not in random_genes) and (entity not in nci_path_dct):
-            continue
-        # Convert lines to floats.
-        entity_vector_dct[entity] = map(float, line.split())
-    f.close()
-    return entity_vector_dct, extension
-
-def create_pathway_vector_matrix(nci_pathways, entity_vector_dct):
-    pathway_vector_matrix = []
-    for pathway in nci_pathways:
-        pathway_vec = entity_vector_dct[pathway]
-        pathway_vector_matrix += [pathway_vec]
-    return np.matrix(pathway_vector_matrix)
-
-def create_gene_vector_matrix(expression_genes, entity_vector_dct):
-    gene_vector_matrix = []
-    for gene in expression_genes:
-        gene_vec = entity_vector_dct[gene]
-        gene_vector_matrix += [gene_vec]
-    return np.matrix(gene_vector_matrix)
-
-def compute_drug_path_score(random_genes, nci_pathways, cosine_matrix,
-    path_score_dct):
-    '''
-    Given a dictionary where keys are genes and values are p-values of the
-    correlation between the key and the input drug, we return a dictionary.
-    Each key is a (drug, pathway) pair.
-    Each value is the NetPath score, given by the sum of the cosine between
-    each path and each gene of the highly correlated gene set, multiplied by
-    that gene's p-value for the input drug.
-    '''
-    for path_i, pathway in enumerate(nci_pathways):
-        # Initialize the score.
-        drug_path_score = 0.0
-        for gene_i, gene in enumerate(random_genes):
-            # Correlation between gene and drug response.
-            # cos = cosine_dct[gene]
-            # drug_path_score += abs(cos * gene_drug_corr)
-            drug_path_score += cosine_matrix[path_i, gene_i]
-        path_score_dct[pathway] += [drug_path_score]
+def get_unit_vector_matrix(emb_mat, node_index_dct, node_lst):
+    '''
+    Returns the matrix of embedding vectors for the nodes in node_lst, each
+    scaled to unit length, so that dot products between rows are cosines.
+    '''
+    vector_matrix = file_operations.get_node_vectors(emb_mat, node_index_dct,
+        node_lst)
+    return vector_matrix / linalg.norm(vector_matrix, axis=1)[:, np.newaxis]
+
+def get_random_gene_subsets(random_state, num_subsets, num_genes,
+    subset_size):
+    '''
+    Draws num_subsets random sets of subset_size distinct gene indices out of
+    num_genes from random_state. Returns a num_subsets x subset_size index
+    array.
+    '''
+    # The subset_size genes with the smallest random keys form a uniform
+    # random subset.
+    random_keys = random_state.rand(num_subsets, num_genes)
+    return np.argpartition(random_keys, subset_size - 1, axis=1)[:,
+        :subset_size]
+
+def compute_null_path_scores(cosine_matrix, gene_subsets):
+    '''
+    Each random gene set's score for a pathway is the sum of the cosines
+    between the pathway and the set's genes. Returns the pathways x subsets
+    matrix of scores, given the pathways x genes cosine_matrix and the subsets
+    x subset_size gene_subsets index array.
+    '''
+    num_subsets, subset_size = gene_subsets.shape
+    # Indicator matrix of the genes in each subset.
+    subset_matrix = sparse.csr_matrix((np.ones(gene_subsets.size), (np.repeat(
+        np.arange(num_subsets), subset_size), gene_subsets.ravel())), shape=(
+        num_subsets, cosine_matrix.shape[1]))
+    return subset_matrix.dot(cosine_matrix.T).T
 
 def write_top_pathway_file(network, extension, top_k, path_score_dct, subfolder,
     out_fname):
@@ -101,50 +94,142 @@ def write_top_pathway_file(network, extension, top_k, path_score_dct, subfolder,
             path_score_dct[pathway]))))
     out.close()
 
-def find_top_pathways(network, top_k):
-    # Extract the NCI pathway data.
-    nci_path_dct, nci_genes = file_operations.get_nci_path_dct()
+def write_sorted_null_file(fname, nci_pathways, null_score_matrix):
+    '''
+    Writes each pathway's random scores, sorted, to a binary file for
+    compute_p_values_netpath.py.
+    '''
+    f = open(fname + '.tmp', 'wb')
+    np.savez(f, path_lst=np.array(nci_pathways), null_score_matrix=np.sort(
+        null_score_matrix, axis=1))
+    f.close()
+    os.rename(fname + '.tmp', fname)
+
+def score_permutation_block(block_i):
+    '''
+    Scores the block_i-th block of block_size random gene sets. Each block has
+    its own random stream, seeded by (seed, block_i), so a block's scores do
+    not depend on which worker runs it or on the blocks run before it. Uses
+    the globals set by find_top_pathways, which forked workers share.
+    Returns the pathways x block_size matrix of scores.
+    '''
+    random_state = np.random.RandomState([args.seed, block_i])
+    gene_subsets = get_random_gene_subsets(random_state, args.block_size,
+        cosine_matrix.shape[1], args.top_k)
+    return compute_null_path_scores(cosine_matrix, gene_subsets)
+
+def write_checkpoint(checkpoint_fname, nci_pathways, score_block_lst):
+    '''
+    Saves the scores of the blocks finished so far, so a later run can resume
+    from them. The checkpoint is written under a temporary name and renamed.
+    '''
+    f = open(checkpoint_fname + '.tmp', 'wb')
+    np.savez(f, seed=args.seed, block_size=args.block_size, top_k=args.top_k,
+        path_lst=np.array(nci_pathways), null_score_matrix=np.hstack(
+        score_block_lst))
+    f.close()
+    os.rename(checkpoint_fname + '.tmp', checkpoint_fname)
+
+def read_checkpoint(checkpoint_fname, nci_pathways):
+    '''
+    Returns the list of finished score blocks saved in the checkpoint, or an
+    empty list if there is no checkpoint of a run with the same settings.
+    '''
+    if not os.path.exists(checkpoint_fname):
+        return []
+    checkpoint = np.load(checkpoint_fname)
+    if (int(checkpoint['seed']) != args.seed or int(checkpoint['block_size']
+        ) != args.block_size or int(checkpoint['top_k']) != args.top_k or
+        checkpoint['path_lst'].tolist() != nci_pathways):
+        print('Ignoring checkpoint %s of a run with other settings' % (
+            checkpoint_fname))
+        return []
+    null_score_matrix = checkpoint['null_score_matrix']
+    return np.hsplit(null_score_matrix, null_score_matrix.shape[1] //
+        args.block_size)
+
+def find_top_pathways():
+    global cosine_matrix
     # Find genes and pathways that appear in embedding.
-    embedding_gene_pathway_lst = (
-        file_operations.get_embedding_gene_pathway_lst())
-
-    # Initialize the path score dictionary with all pathways as keys and empty
-    # lists as values.
-    path_score_dct = {}
-    for pathway in nci_path_dct:
-        path_score_dct[pathway] = []
-
-    for i in range(10000):
-        # Find the most significantly correlated genes for each drug.
-        random_genes = file_operations.get_corr_drug_random_genes(top_k,
-            embedding_gene_pathway_lst)
-
-        # dimension_list = create_dimension_list(network)
-        entity_vector_dct, extension = get_entity_vector(network, '50', 'U',
-            embedding_gene_pathway_lst, random_genes, nci_path_dct)
-
-        # Compute cosine matrix.
-        nci_pathways = nci_path_dct.keys()
-        pathway_vector_matrix = create_pathway_vector_matrix(nci_pathways,
-            entity_vector_dct)
-        gene_vector_matrix = create_gene_vector_matrix(random_genes,
-            entity_vector_dct)
-        cosine_matrix = (pathway_vector_matrix * gene_vector_matrix.T
-            ) / linalg.norm(pathway_vector_matrix, axis=1
-            )[:, np.newaxis] / linalg.norm(gene_vector_matrix, axis=1)
-
-        # Calculate the score for each drug-pathway pair.
-        compute_drug_path_score(random_genes, nci_pathways, cosine_matrix,
-            path_score_dct)
-    
-    subfolder = './results/random_embedding/'
+    embedding_gene_pathway_lst = file_operations.get_emb_node_lst()
+    # Genes in both the embedding and the gene expression data.
+    random_gene_candidates = file_operations.get_random_gene_candidates(
+        embedding_gene_pathway_lst)
+
+    # Read the embedding once, and compute the cosine between every pathway
+    # and every candidate gene.
+    filename, extension = get_embedding_fname(args.network, '50', 'U')
+    emb_mat, node_index_dct = file_operations.get_embedding_store(filename,
+        embedding_gene_pathway_lst)
+    nci_pathways = [path for path in pathway_index.get_pathway_index(
+        ).path_lst if path in node_index_dct]
+    cosine_matrix = get_unit_vector_matrix(emb_mat, node_index_dct,
+        nci_pathways).dot(get_unit_vector_matrix(emb_mat, node_index_dct,
+        random_gene_candidates).T)
 
-    out_fname = 'random_%s_top_pathways_%s_top_%d.txt' % (network, extension, top_k)
-    write_top_pathway_file(network, extension, top_k, path_score_dct,
-        subfolder, out_fname)
+    subfolder = './results/random_embedding/'
+    out_fname = 'random_%s_top_pathways_%s_top_%d.txt' % (args.network,
+        extension, args.top_k)
+    checkpoint_fname = '%s%s.checkpoint.npz' % (subfolder, out_fname)
+
+    # Score num_permutations random sets of top_k genes for every pathway, in
+    # blocks of block_size sets.
+    num_blocks = -(-args.num_permutations // args.block_size)
+    score_block_lst = []
+    if args.resume:
+        score_block_lst = read_checkpoint(checkpoint_fname, nci_pathways)
+        print('Resuming after %d of %d blocks' % (len(score_block_lst),
+            num_blocks))
+    block_lst = range(len(score_block_lst), num_blocks)
+
+    # Workers are forked after the cosine matrix is computed, so they share
+    # it. Blocks come back in order whatever worker scored them.
+    if args.num_workers > 1:
+        pool = Pool(processes=args.num_workers)
+        results = pool.imap(score_permutation_block, block_lst)
+    else:
+        results = (score_permutation_block(block_i) for block_i in block_lst)
+
+    for score_block in results:
+        score_block_lst += [score_block]
+        if (len(score_block_lst) % args.checkpoint_blocks == 0 or len(
+            score_block_lst) == num_blocks):
+            write_checkpoint(checkpoint_fname, nci_pathways, score_block_lst)
+    if args.num_workers > 1:
+        pool.close()
+        pool.join()
+
+    null_score_matrix = np.hstack(score_block_lst)[:, :args.num_permutations]
+    path_score_dct = OrderedDict(zip(nci_pathways, null_score_matrix.tolist()))
+    write_top_pathway_file(args.network, extension, args.top_k,
+        path_score_dct, subfolder, out_fname)
+    write_sorted_null_file(subfolder + out_fname.replace('.txt', '.null.npz'),
+        nci_pathways, null_score_matrix)
+
+def parse_args():
+    global args
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--network', type=str, default='ppi',
+        help='Network of the embedding file.')
+    parser.add_argument('-k', '--top_k', type=int, default=250,
+        help='Number of random genes in each gene set.')
+    parser.add_argument('-p', '--num_permutations', type=int, default=10000,
+        help='Number of random gene sets scored for each pathway.')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+        help='Seed of the random gene sets.')
+    parser.add_argument('-b', '--block_size', type=int, default=500,
+        help='Number of random gene sets in each block.')
+    parser.add_argument('-c', '--checkpoint_blocks', type=int, default=10,
+        help='Number of blocks between checkpoints.')
+    parser.add_argument('-r', '--resume', action='store_true',
+        help='Resume from the last checkpoint of a run with the same settings.')
+    parser.add_argument('-w', '--num_workers', type=int, default=1,
+        help='Number of blocks to score in parallel.')
+    args = parser.parse_args()
 
 def main():
-    find_top_pathways('ppi', 250)
+    parse_args()
+    find_top_pathways()
 
 if __name__ == '__main__':
     start_time = time.time()
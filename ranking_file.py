@@ -0,0 +1,178 @@
+### Author: Edward Huang
+
+import file_operations
+import numpy as np
+
+### Reader of the drug-pathway ranking files, the top pathway files that the
+### embedding, correlation and expression scripts write. Each of these files
+### has two header lines followed by lines of drug, pathway, score and optional
+### extra columns, with '[]' for pairs without a score. The file is parsed
+### once into integer-coded drug and pathway columns, which are saved with
+### their indices to a binary sidecar cache. Scripts then look up one drug,
+### one threshold or one pair without scanning the text file again.
+
+class RankingFile(object):
+    '''
+    Columns of a ranking file, one entry per line in file order.
+    drug_lst, path_lst: distinct drugs and pathways, in order of first
+        appearance -> list(str)
+    drug_ids, path_ids: drug and pathway codes of each line -> np.array(int)
+    scores: score of each line, NaN for '[]' -> np.array(float)
+    score_strs: score of each line, as written in the file -> np.array(str)
+    '''
+    def __init__(self, drug_lst, path_lst, drug_ids, path_ids, scores,
+        score_strs, index_dct=None):
+        self.drug_lst, self.path_lst = drug_lst, path_lst
+        self.drug_index_dct = dict((drug, i) for i, drug in enumerate(
+            drug_lst))
+        self.path_index_dct = dict((path, i) for i, path in enumerate(
+            path_lst))
+        self.drug_ids, self.path_ids = drug_ids, path_ids
+        self.scores, self.score_strs = scores, score_strs
+        if index_dct is None:
+            index_dct = get_ranking_index(drug_ids, path_ids, scores, len(
+                drug_lst), len(path_lst))
+        # Lines grouped by drug, in file order within each drug.
+        self.drug_line_ids = index_dct['drug_line_ids']
+        self.drug_indptr = index_dct['drug_indptr']
+        # Scored lines by increasing score.
+        self.score_line_ids = index_dct['score_line_ids']
+        self.sorted_scores = scores[self.score_line_ids]
+        # Lines by increasing drug-pathway key.
+        self.pair_line_ids = index_dct['pair_line_ids']
+        self.sorted_pair_keys = self.get_pair_keys(drug_ids[
+            self.pair_line_ids], path_ids[self.pair_line_ids])
+
+    def get_pair_keys(self, drug_ids, path_ids):
+        '''
+        Returns one integer key per drug-pathway pair -> np.array(int)
+        '''
+        return np.asarray(drug_ids, dtype=np.int64) * len(self.path_lst) + (
+            path_ids)
+
+    def get_pairs(self, line_ids):
+        '''
+        Returns the drug-pathway pair of each line id -> list((str, str))
+        '''
+        return [(self.drug_lst[drug_i], self.path_lst[path_i]) for drug_i,
+            path_i in zip(self.drug_ids[line_ids].tolist(), self.path_ids[
+            line_ids].tolist())]
+
+    def get_drug_line_ids(self, drug):
+        '''
+        Returns the line ids of the drug's lines, in file order, or an empty
+        array if the drug is not in the file -> np.array(int)
+        '''
+        if drug not in self.drug_index_dct:
+            return np.zeros(0, dtype=int)
+        drug_i = self.drug_index_dct[drug]
+        return self.drug_line_ids[self.drug_indptr[drug_i]:self.drug_indptr[
+            drug_i + 1]]
+
+    def get_top_pathways(self, drug, num_paths):
+        '''
+        Returns the drug's first num_paths distinct scored pathways, in file
+        order -> list(str)
+        '''
+        line_ids = self.get_drug_line_ids(drug)
+        top_path_lst, top_path_set = [], set([])
+        for path_i in self.path_ids[line_ids[~np.isnan(self.scores[line_ids])]
+            ]:
+            if len(top_path_lst) == num_paths:
+                break
+            if path_i not in top_path_set:
+                top_path_set.add(path_i)
+                top_path_lst += [self.path_lst[path_i]]
+        return top_path_lst
+
+    def get_line_ids_below(self, score_thresh):
+        '''
+        Returns the line ids of the scored lines with scores at most
+        score_thresh, in file order -> np.array(int)
+        '''
+        num_below = np.searchsorted(self.sorted_scores, score_thresh,
+            side='right')
+        return np.sort(self.score_line_ids[:num_below])
+
+    def get_score(self, drug, path):
+        '''
+        Returns the score of the first line of the drug-pathway pair, NaN if
+        that line has no score, or None if the pair is not in the file.
+        '''
+        if drug not in self.drug_index_dct or path not in self.path_index_dct:
+            return None
+        pair_key = self.get_pair_keys(self.drug_index_dct[drug],
+            self.path_index_dct[path])
+        key_i = np.searchsorted(self.sorted_pair_keys, pair_key)
+        if (key_i == len(self.sorted_pair_keys) or self.sorted_pair_keys[key_i]
+            != pair_key):
+            return None
+        return float(self.scores[self.pair_line_ids[key_i]])
+
+def get_ranking_index(drug_ids, path_ids, scores, num_drugs, num_paths):
+    '''
+    Returns a dictionary of the index arrays of a RankingFile's columns.
+    Key: index name -> str
+    Value: line ids or offsets -> np.array(int)
+    '''
+    scored_line_ids = np.nonzero(~np.isnan(scores))[0]
+    pair_keys = np.asarray(drug_ids, dtype=np.int64) * num_paths + path_ids
+    # Stable sorts keep file order among equal drugs, scores and pairs.
+    return {'drug_line_ids':np.argsort(drug_ids, kind='mergesort'),
+        'drug_indptr':np.concatenate(([0], np.cumsum(np.bincount(drug_ids,
+            minlength=num_drugs)))),
+        'score_line_ids':scored_line_ids[np.argsort(scores[scored_line_ids],
+            kind='mergesort')],
+        'pair_line_ids':np.argsort(pair_keys, kind='mergesort')}
+
+def read_ranking_file(fname):
+    '''
+    Parses a ranking file into a RankingFile, skipping the two header lines.
+    '''
+    drug_lst, drug_index_dct, drug_ids = [], {}, []
+    path_lst, path_index_dct, path_ids = [], {}, []
+    score_strs = []
+    f = open(fname, 'r')
+    for i, line in enumerate(f):
+        # Skip header lines.
+        if i < 2:
+            continue
+        drug, path, score = line.strip().split('\t')[:3]
+        if drug not in drug_index_dct:
+            drug_index_dct[drug] = len(drug_lst)
+            drug_lst += [drug]
+        if path not in path_index_dct:
+            path_index_dct[path] = len(path_lst)
+            path_lst += [path]
+        drug_ids += [drug_index_dct[drug]]
+        path_ids += [path_index_dct[path]]
+        score_strs += [score]
+    f.close()
+    scores = np.array([np.nan if score == '[]' else float(score) for score in
+        score_strs])
+    return RankingFile(drug_lst, path_lst, np.array(drug_ids, dtype=int),
+        np.array(path_ids, dtype=int), scores, np.array(score_strs, dtype=str))
+
+def get_ranking_file(fname):
+    '''
+    Returns the RankingFile of fname. The first call saves the columns and
+    their indices to the binary cache, and later calls read them back instead
+    of parsing the file, until the file changes.
+    '''
+    cache_prefix = file_operations.get_cache_prefix(fname, tag='.ranking')
+    scores, label_dct = file_operations.load_matrix_cache(cache_prefix)
+    if scores is not None:
+        return RankingFile(label_dct['drug_lst'].tolist(), label_dct[
+            'path_lst'].tolist(), label_dct['drug_ids'], label_dct['path_ids'],
+            scores, label_dct['score_strs'], label_dct)
+
+    ranking_file = read_ranking_file(fname)
+    file_operations.write_matrix_cache(cache_prefix, ranking_file.scores,
+        drug_lst=np.array(ranking_file.drug_lst, dtype=str), path_lst=np.array(
+        ranking_file.path_lst, dtype=str), drug_ids=ranking_file.drug_ids,
+        path_ids=ranking_file.path_ids, score_strs=ranking_file.score_strs,
+        drug_line_ids=ranking_file.drug_line_ids,
+        drug_indptr=ranking_file.drug_indptr,
+        score_line_ids=ranking_file.score_line_ids,
+        pair_line_ids=ranking_file.pair_line_ids)
+    return ranking_file
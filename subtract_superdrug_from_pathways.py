@@ -1,6 +1,8 @@
 ### Author: Edward Huang
 
 from collections import OrderedDict
+import numpy as np
+import ranking_file
 import sys
 
 ### Goes through the top pathways for any given method, and takes out the top
@@ -8,21 +10,14 @@ import sys
 sub_dir = './results/'
 
 def get_top_pathways(method):
-    top_pathways = OrderedDict({})
     if method == 'exp':
         filename = 'top_pathways_exp_hgnc.txt'
     elif method == 'genetic':
         filename = 'embedding/genetic_top_pathways_500_0.8.US_top_250.txt'
-    f = open(sub_dir + filename, 'r')
-    for i, line in enumerate(f):
-        if i < 2:
-            continue
-        line = line.strip().split('\t')
-        assert len(line) == 7 or len(line) == 3
-        drug, path, score = line[:3]
-        assert (drug, path) not in top_pathways
-        top_pathways[(drug, path)] = score
-    f.close()
+    rankings = ranking_file.get_ranking_file(sub_dir + filename)
+    drug_path_lst = rankings.get_pairs(np.arange(len(rankings.scores)))
+    top_pathways = OrderedDict(zip(drug_path_lst, rankings.score_strs.tolist()))
+    assert len(top_pathways) == len(drug_path_lst)
     return top_pathways
 
 def get_superdrug_pathways(superdrug_p_value):
@@ -1,6 +1,7 @@
 ### Author: Edward Huang
 
-from collections import OrderedDict
+from multiprocessing import Pool
+import numpy as np
 import os
 import sys
 
@@ -10,131 +11,133 @@ import sys
 ### 0.001
 ### 0.005
 ### ...
+### All comparison files are counted into one files x method_p x lincs_p
+### array, which gives every summary table and the comparison with KW.
 
 comparison_p_thresh = 0.05
 p_thresh_range = [0.001, 0.005, 0.01, 0.05, 0.1]
 results_folder = './results'
 
-def count_below_comparison_p(in_filename, comparison_p_thresh):
+def get_threshold_indices(p_values):
+    '''
+    Returns the index in p_thresh_range of each p-value, or len(p_thresh_range)
+    for p-values that are not one of the thresholds -> np.array(int)
+    '''
+    thresh_arr = np.array(p_thresh_range)
+    thresh_indices = np.minimum(np.searchsorted(thresh_arr, p_values),
+        len(thresh_arr) - 1)
+    thresh_indices[thresh_arr[thresh_indices] != p_values] = len(thresh_arr)
+    return thresh_indices
+
+def count_below_comparison_p(in_filename):
     '''
     Reads a comparison file between LINCS and a particular method, dictated by
     in_filename. Counts the number of drugs for each pair of p-values that
     are better than comparison_p_thresh.
-    Returns a dictionary.
-    Key: (method p-value, lincs p-value) pair -> (float, float)
-    Value: number of drugs better than comparison_p_thresh -> int
+    Returns a matrix. Rows are method p-values and columns are LINCS p-values,
+    both in the order of p_thresh_range. Values are numbers of drugs better
+    than comparison_p_thresh -> np.array(int)
     '''
-    table_dct = OrderedDict({})
-
+    p_value_lst = []
     f = open('%s/lincs_z%s_max%s_comparison_files/%s' % (results_folder,
         lincs_z, lincs_max_num, in_filename), 'r')
     for i, line in enumerate(f):
         if i == 0:
             continue
-
         line = line.split()
-        method_p, lincs_p, comparison_p = map(float, (line[0], line[1], 
-            line[-1]))
-        drug = line[2]
-
-        # Update the number of p-values below comparison_p_thresh.
-        if comparison_p < comparison_p_thresh:
-            if (method_p, lincs_p) in table_dct:
-                table_dct[(method_p, lincs_p)] += 1
-            else:
-                table_dct[(method_p, lincs_p)] = 1
+        p_value_lst += [(line[0], line[1], line[-1])]
     f.close()
-
-    return table_dct
-
-def write_comparison_table(in_filename, table_dct):
+    # Columns are the method, LINCS and comparison p-values.
+    p_value_matrix = np.array(p_value_lst, dtype=float).reshape(-1, 3)
+
+    num_thresh = len(p_thresh_range)
+    method_indices = get_threshold_indices(p_value_matrix[:, 0])
+    lincs_indices = get_threshold_indices(p_value_matrix[:, 1])
+    is_counted = ((method_indices < num_thresh) & (lincs_indices < num_thresh)
+        & (p_value_matrix[:, 2] < comparison_p_thresh))
+    return np.bincount(method_indices[is_counted] * num_thresh +
+        lincs_indices[is_counted], minlength=num_thresh ** 2).reshape(
+        num_thresh, num_thresh)
+
+def count_all_below_comparison_p(in_filename_lst, num_workers):
+    '''
+    Returns the stacked tables of count_below_comparison_p for every file in
+    in_filename_lst, with files parsed by num_workers processes.
+    Returns an array of files x method p-values x LINCS p-values -> np.array
+    '''
+    if num_workers > 1:
+        pool = Pool(processes=num_workers)
+        table_lst = pool.map(count_below_comparison_p, in_filename_lst)
+        pool.close()
+        pool.join()
+    else:
+        table_lst = [count_below_comparison_p(in_filename) for in_filename in
+            in_filename_lst]
+    return np.array(table_lst, dtype=int).reshape(-1, len(p_thresh_range),
+        len(p_thresh_range))
+
+def write_comparison_table(in_filename, comparison_table):
     '''
     Write out the table created by count_below_comparison_p().
     '''
     out = open('%s/summ_%s' % (out_folder, in_filename), 'w')
     out.write('\t' + '\t'.join(map(str, p_thresh_range)) + '\n')
-    for method_p in p_thresh_range:
+    for method_i, method_p in enumerate(p_thresh_range):
         out.write(str(method_p))
-        for lincs_p in p_thresh_range:
-            # If we recorded nothing for a pair of thresholds, then we just
-            # write a 0.
-            if (method_p, lincs_p) not in table_dct:
-                out.write('\t0')
-            else:
-                out.write('\t%d' % table_dct[(method_p, lincs_p)])
+        for lincs_i, lincs_p in enumerate(p_thresh_range):
+            out.write('\t%d' % comparison_table[method_i, lincs_i])
         out.write('\n')
     out.close()
 
-def summarize_file_and_write(in_filename, comparison_p_thresh):
-    table_dct = count_below_comparison_p(in_filename, comparison_p_thresh)
-    write_comparison_table(in_filename, table_dct)
-
-def read_correlation_table(corr_kw_fname):
+def get_embedding_fnames(base_fname, embed_top_k):
     '''
-    Reads the correlation with KW summary previously written by
-    summarize_file_and_write.
-    Return: list of table values -> list(float)
+    Returns the names of the NETPATH comparison files -> list(str)
     '''
-    correlation_table = []
-
-    correlation_file = open('%s/summ_%s' % (out_folder, corr_kw_fname), 'r')
-    for i, line in enumerate(correlation_file):
-        if i == 0:
-            continue
-        line = map(float, line.split())[1:]
-        correlation_table += line
-    correlation_file.close()
-
-    return correlation_table
+    embedding_fname_lst = []
+    for method in ['genetic', 'literome', 'sequence', 'ppi']:
+        dimensions = [str(dim) for dim in [50, 100, 500]]
+        if method == 'ppi':
+            dimensions += [str(dim) for dim in [1000, 1500, 2000]]
+        for dim in dimensions:
+            for suffix in ['U', 'US']:
+                extension = '%s_0.8.%s' % (dim, suffix)
+                embedding_fname_lst += ['%s%s_%s_embed%d.txt' % (base_fname,
+                    method, extension, embed_top_k)]
+    return embedding_fname_lst
 
-def write_best_files(base_fname, embed_top_k, correlation_table):
+def write_best_files(embedding_fname_lst, embedding_tables,
+    correlation_table):
     '''
     Determines what the best NETPATH files are, as compared to the correlation
-    with KW files.
+    with KW files. A file scores 1 for each cell of its table above the
+    correlation table's, and 0.5 for each tie.
     '''
+    num_better_than_correlation = ((embedding_tables > correlation_table).sum(
+        axis=(1, 2)) + 0.5 * (embedding_tables == correlation_table).sum(
+        axis=(1, 2)))
+
     out = open('%s/best_files.txt' % (out_folder), 'w')
     out.write('filename\tnum_better_than_kw\n')
-    # Get the embedding summaries.
-    for method in ['genetic', 'literome', 'sequence','ppi']:
-        dimensions = map(str, [50, 100, 500])
-        if method == 'ppi':
-            dimensions += map(str, [1000, 1500, 2000])
-        for num in dimensions:
-            for suffix in ['U', 'US']:
-                entity_vector_dct = OrderedDict({})
-
-                extension = '%s_0.8.%s' % (num, suffix)
-                embedding_fname = '%s/summ_%s%s_%s_embed%d.txt' % (
-                    out_folder, base_fname, method, extension, embed_top_k)
-
-                embedding_table = []
-                f = open(embedding_fname, 'r')
-                for i, line in enumerate(f):
-                    if i == 0:
-                        continue
-                    line = map(float, line.split())[1:]
-                    embedding_table += line
-                f.close()
-
-                num_better_than_correlation = 0
-                for i, val in enumerate(embedding_table):
-                    if val > correlation_table[i]:
-                        num_better_than_correlation += 1
-                    elif val == correlation_table[i]:
-                        num_better_than_correlation += 0.5
-                if num_better_than_correlation >= 8:
-                    out.write('%s\t%d\n' % (embedding_fname[
-                        embedding_fname.index('summ'):],
-                        num_better_than_correlation))
+    for embedding_fname, num_better in zip(embedding_fname_lst,
+        num_better_than_correlation.tolist()):
+        if num_better >= 8:
+            summary_fname = '%s/summ_%s' % (out_folder, embedding_fname)
+            out.write('%s\t%d\n' % (summary_fname[summary_fname.index(
+                'summ'):], num_better))
+    out.close()
 
 if __name__ == '__main__':
-    if (len(sys.argv) != 4):
-        print "Usage: " + sys.argv[0] + " lincs_z lincs_max_num embed_top_k"
+    if (len(sys.argv) not in [4, 5]):
+        print ("Usage: " + sys.argv[0] + " lincs_z lincs_max_num embed_top_k "
+            "num_workers<optional>")
         exit(1)
     global lincs_z, lincs_max_num    
     lincs_z, lincs_max_num,  = sys.argv[1], sys.argv[2]
     assert lincs_max_num.isdigit()
     embed_top_k = int(sys.argv[3])
+    num_workers = 1
+    if len(sys.argv) == 5:
+        num_workers = int(sys.argv[4])
 
     # Create the outfile folder, if necessary.
     global out_folder
@@ -146,23 +149,16 @@ if __name__ == '__main__':
     # File name for all files.
     base_fname = 'compare_lincs_Aft_3_and_'
     corr_kw_fname = 'compare_lincs_Aft_3_and_corr_kw.txt'
-    
-    # Summarizing correlation with KW file.
-    summarize_file_and_write(corr_kw_fname, comparison_p_thresh)
+    embedding_fname_lst = get_embedding_fnames(base_fname, embed_top_k)
 
-    # Summarizing NETPATH files.
-    for method in ['genetic', 'literome', 'sequence', 'ppi']:
-        dimensions = map(str, [50, 100, 500])
-        if method == 'ppi':
-            dimensions += map(str, [1000, 1500, 2000])
-        for dim in dimensions:
-            for suffix in ['U', 'US']:
-                extension = '%s_0.8.%s' % (dim, suffix)
-                embedding_fname = '%s%s_%s_embed%d.txt' % (base_fname,
-                    method, extension, embed_top_k)
-                summarize_file_and_write(embedding_fname, comparison_p_thresh)
+    # Summarizing the correlation with KW file and the NETPATH files, stacked
+    # with the correlation with KW table first.
+    comparison_tables = count_all_below_comparison_p([corr_kw_fname] +
+        embedding_fname_lst, num_workers)
+    for in_filename, comparison_table in zip([corr_kw_fname] +
+        embedding_fname_lst, comparison_tables):
+        write_comparison_table(in_filename, comparison_table)
 
     # Comparing correlation with KW to NETPATH files.
-    correlation_table = read_correlation_table(corr_kw_fname)
-
-    write_best_files(base_fname, embed_top_k, correlation_table)
\ No newline at end of file
+    write_best_files(embedding_fname_lst, comparison_tables[1:],
+        comparison_tables[0])
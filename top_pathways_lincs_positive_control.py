@@ -2,7 +2,7 @@
 
 import numpy as np
 from collections import OrderedDict
-from scipy.stats import fisher_exact
+import fisher_test
 import operator
 import sys
 
@@ -143,8 +143,8 @@ if __name__ == '__main__':
             corr_not_path = len(corr_genes.difference(path_genes))
             path_not_corr = len(path_genes.difference(corr_genes))
             neither = total_num_genes - len(corr_genes.union(path_genes))
-            o_r, p_value = fisher_exact([[corr_and_path, corr_not_path],
-                [path_not_corr, neither]])
+            p_value = fisher_test.FishersExactTest([[corr_and_path,
+                corr_not_path], [path_not_corr, neither]]).two_tail_p()
             if p_value < LOW_P_THRESHOLD:
                 num_low_p += 1
             fish_dct[(drug, path, corr_and_path, len(corr_genes), n)] = p_value
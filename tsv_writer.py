@@ -0,0 +1,82 @@
+### Author: Edward Huang
+
+import gzip
+from itertools import islice
+import numpy as np
+import os
+
+### Bulk writer of the tab-separated result files. Rows are formatted a chunk
+### at a time, with one string format of the row format repeated over the
+### chunk, and written to a large output buffer. The bytes are the same as
+### formatting and writing each row on its own. Files whose names end in .gz
+### or .zst are compressed with gzip or zstandard.
+
+# Number of rows formatted per write.
+CHUNK_SIZE = 65536
+# Size of the output file buffer, in bytes.
+BUFFER_SIZE = 1 << 22
+
+class TsvWriter(object):
+    '''
+    Writes a result file under a temporary name, and renames it to fname on
+    close, so that a failed or interrupted run never leaves a partial file.
+    '''
+    def __init__(self, fname):
+        self.fname = fname
+        self.num_bytes = 0
+        tmp_fname = fname + '.tmp'
+        if fname.endswith('.gz'):
+            self.out = gzip.open(tmp_fname, 'wb')
+        elif fname.endswith('.zst'):
+            # Only needed for zstandard outputs.
+            import zstandard
+            self.out = zstandard.ZstdCompressor().stream_writer(open(
+                tmp_fname, 'wb', BUFFER_SIZE))
+        else:
+            self.out = open(tmp_fname, 'wb', BUFFER_SIZE)
+
+    def write(self, text):
+        '''
+        Writes a string, such as a header line.
+        '''
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        self.out.write(text)
+        self.num_bytes += len(text)
+
+    def tell(self):
+        '''
+        Returns the number of uncompressed bytes written so far, which is the
+        offset in the file for uncompressed files.
+        '''
+        return self.num_bytes
+
+    def write_rows(self, row_fmt, row_iter):
+        '''
+        Writes each tuple of row_iter formatted with row_fmt, for instance
+        '%s\t%s\t%g\n'.
+        '''
+        row_iter = iter(row_iter)
+        while True:
+            row_lst = list(islice(row_iter, CHUNK_SIZE))
+            if row_lst == []:
+                break
+            self.write((row_fmt * len(row_lst)) % tuple([value for row in
+                row_lst for value in row]))
+
+    def write_columns(self, row_fmt, column_lst):
+        '''
+        Writes the rows of a list of equal-length columns (lists or NumPy
+        arrays) formatted with row_fmt.
+        '''
+        num_rows = len(column_lst[0])
+        for start in range(0, num_rows, CHUNK_SIZE):
+            chunk_lst = [column[start:start + CHUNK_SIZE] for column in
+                column_lst]
+            chunk_lst = [chunk.tolist() if isinstance(chunk, np.ndarray) else
+                chunk for chunk in chunk_lst]
+            self.write_rows(row_fmt, zip(*chunk_lst))
+
+    def close(self):
+        self.out.close()
+        os.rename(self.fname + '.tmp', self.fname)
@@ -1,6 +1,8 @@
 ### Author: Edward Huang
 
 import file_operations
+import numpy as np
+import ranking_file
 import time
 
 ### Various scripts to perform case studies in the paper.
@@ -47,22 +49,20 @@ def get_p_values_given_drugs(fname, drugs):
     pathway pairs.
     '''
     name_to_brd_dct = get_name_to_brd_dct()
-    drug_pathway_dict = {}
-    f = open(fname, 'r')
-    for i, line in enumerate(f):
-        # Skip header line.
-        if i < 2:
-            continue
-        line = line.strip().split('\t')
-        drug, path, score = line[:3]
+    rankings = ranking_file.get_ranking_file(fname)
+    # Only read the lines of the file's drugs that are, or convert back to,
+    # one of the given BRD IDs.
+    line_ids = np.sort(np.concatenate([np.zeros(0, dtype=int)] + [
+        rankings.get_drug_line_ids(drug) for drug in rankings.drug_lst if
+        name_to_brd_dct.get(drug, drug) in drugs]))
 
+    drug_pathway_dict = {}
+    for (drug, path), score in zip(rankings.get_pairs(line_ids),
+        rankings.score_strs[line_ids].tolist()):
         # Convert back to BRD ID if 
         if drug in name_to_brd_dct:
             drug = name_to_brd_dct[drug]
-
-        if drug in drugs:
-            drug_pathway_dict[(drug, path)] = score
-    f.close()
+        drug_pathway_dict[(drug, path)] = score
     return drug_pathway_dict
 
 def get_name_to_brd_dct():